@@ -0,0 +1,608 @@
+'''
+In-process stand-in for the subset of the CouchDB HTTP API used by Cozy
+FUSE: databases, documents, _bulk_docs, attachments (with ranges), the
+normal changes feed and the views created by dbutils. Views and filters are
+implemented in Python, the JavaScript of design documents is stored but
+never run. Everything is kept in memory.
+'''
+import re
+import json
+import time
+import uuid
+import socket
+import base64
+import bisect
+import hashlib
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+def _type_filter(doc_type):
+    return lambda doc: doc.get('docType') == doc_type
+
+
+def _type_view(doc_type, get_key):
+    def view(doc):
+        if doc.get('docType') == doc_type:
+            yield (get_key(doc), doc)
+    return view
+
+
+def _tree_value(doc):
+    return dict((key, doc.get(key)) for key in
+                ['name', 'docType', 'size', 'lastModification'])
+
+
+def _by_parent(doc):
+    if doc.get('docType') in ('File', 'Folder'):
+        yield (doc.get('path'), _tree_value(doc))
+
+
+def _by_subtree(doc):
+    if doc.get('docType') in ('File', 'Folder'):
+        parts = [part for part in doc.get('path', '').split('/') if part]
+        value = _tree_value(doc)
+        value['path'] = doc.get('path')
+        value['binary'] = ((doc.get('binary') or {}).get('file') or
+                           {}).get('id')
+        yield (parts + [doc.get('name')], value)
+
+
+# Python versions of the views created by dbutils.init_database_views.
+VIEWS = {
+    'tree/byParent': _by_parent,
+    'tree/bySubtree': _by_subtree,
+    'device/all': _type_view('Device', lambda doc: doc.get('login')),
+    'device/byUrl': _type_view('Device', lambda doc: doc.get('url')),
+    'binary/all': _type_view('Binary', lambda doc: doc['_id']),
+}
+FILTERS = {}
+for doc_type in ['File', 'Folder']:
+    design = doc_type.lower()
+    VIEWS[design + '/all'] = _type_view(doc_type, lambda doc: doc['_id'])
+    VIEWS[design + '/byFolder'] = _type_view(
+        doc_type, lambda doc: doc.get('path'))
+    VIEWS[design + '/byFullPath'] = _type_view(
+        doc_type, lambda doc: '%s/%s' % (doc.get('path'), doc.get('name')))
+    FILTERS[design + '/all'] = _type_filter(doc_type)
+
+
+def collation_key(value):
+    '''
+    Sort key following CouchDB view collation: null, booleans, numbers,
+    strings, arrays then objects. Strings are compared by code points.
+    '''
+    if value is None:
+        return (0,)
+    elif value is False:
+        return (1,)
+    elif value is True:
+        return (2,)
+    elif isinstance(value, (int, long, float)):
+        return (3, value)
+    elif isinstance(value, basestring):
+        return (4, value)
+    elif isinstance(value, list):
+        return (5, tuple(collation_key(item) for item in value))
+    else:
+        return (6, tuple(sorted(value.items())))
+
+
+class ViewIndex:
+    '''
+    Rows of a view sorted by key, updated every time a document is saved.
+    '''
+
+    def __init__(self, view, docs):
+        self.view = view
+        self.keys = []
+        self.rows = []
+        self.doc_rows = {}
+        for doc in docs:
+            self.update(doc)
+
+    def update(self, doc):
+        for row in self.doc_rows.pop(doc['_id'], []):
+            index = bisect.bisect_left(self.rows, row)
+            del self.rows[index]
+            del self.keys[index]
+        if doc.get('_deleted'):
+            return
+
+        rows = [(collation_key(key), doc['_id'], key, value)
+                for (key, value) in self.view(doc)]
+        for row in rows:
+            index = bisect.bisect_left(self.rows, row)
+            self.rows.insert(index, row)
+            self.keys.insert(index, row[0])
+        self.doc_rows[doc['_id']] = rows
+
+    def get_range(self, start=None, end=None, inclusive_end=True):
+        '''
+        Return rows of which keys are between start and end (None means no
+        bound).
+        '''
+        if start is None:
+            low = 0
+        else:
+            low = bisect.bisect_left(self.keys, start)
+        if end is None:
+            high = len(self.rows)
+        elif inclusive_end:
+            high = bisect.bisect_right(self.keys, end)
+        else:
+            high = bisect.bisect_left(self.keys, end)
+        return self.rows[low:high]
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, error, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+class Database:
+    '''
+    Documents, attachments and changes of a database.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.attachments = {}
+        self.seq = 0
+        self.changes = {}
+        self.doc_seqs = {}
+        self.indexes = {}
+        self.lock = threading.RLock()
+
+    def get(self, doc_id):
+        doc = self.docs.get(doc_id)
+        if doc is None or doc.get('_deleted'):
+            raise HTTPError(404, 'not_found',
+                            doc is None and 'missing' or 'deleted')
+        return doc
+
+    def save(self, doc, attachments=None):
+        '''
+        Store a new revision of document, return the new revision.
+        *attachments* maps names of attachments to add to (content type,
+        data) couples, it avoids encoding large data in base64.
+        '''
+        with self.lock:
+            doc_id = doc.get('_id') or uuid.uuid4().hex
+            doc['_id'] = doc_id
+            current = self.docs.get(doc_id)
+            if current is not None and (not current.get('_deleted') or
+                                        doc.get('_rev') is not None):
+                if doc.get('_rev') != current['_rev']:
+                    raise HTTPError(409, 'conflict',
+                                    'Document update conflict.')
+            if current is None:
+                generation = 1
+            else:
+                generation = int(current['_rev'].split('-')[0]) + 1
+            rev = '%d-%s' % (generation, uuid.uuid4().hex)
+
+            doc = json.loads(json.dumps(doc))
+            doc['_rev'] = rev
+            if doc.get('_deleted'):
+                doc = {'_id': doc_id, '_rev': rev, '_deleted': True}
+            self._save_attachments(doc, generation, attachments or {})
+            self.docs[doc_id] = doc
+            for index in self.indexes.values():
+                index.update(doc)
+            self._add_change(doc_id)
+            return rev
+
+    def put_attachment(self, doc_id, rev, name, content_type, data):
+        with self.lock:
+            doc = self.docs.get(doc_id)
+            if doc is None or doc.get('_deleted'):
+                doc = {'_id': doc_id}
+            doc = dict(doc, _rev=rev)
+            return self.save(doc, {name: (content_type, data)})
+
+    def get_attachment(self, doc_id, name):
+        self.get(doc_id)
+        attachment = self.attachments.get(doc_id, {}).get(name)
+        if attachment is None:
+            raise HTTPError(404, 'not_found', 'Document is missing '
+                            'attachment')
+        return attachment
+
+    def query(self, view_name, options):
+        '''
+        Return rows of given view matching query options.
+        '''
+        with self.lock:
+            index = self.indexes.get(view_name)
+            if index is None:
+                view = VIEWS.get(view_name)
+                if view is None:
+                    raise HTTPError(404, 'not_found', 'missing_named_view')
+                index = ViewIndex(view, self.docs.values())
+                self.indexes[view_name] = index
+
+            descending = options.get('descending', False)
+            inclusive_end = options.get('inclusive_end', True)
+            if 'keys' in options:
+                rows = []
+                for key in options['keys']:
+                    key = collation_key(key)
+                    rows.extend(index.get_range(key, key))
+            elif 'key' in options:
+                key = collation_key(options['key'])
+                rows = index.get_range(key, key)
+            else:
+                start = options.get('startkey')
+                end = options.get('endkey')
+                if start is not None:
+                    start = collation_key(start)
+                if end is not None:
+                    end = collation_key(end)
+                if descending:
+                    rows = index.get_range(end, start)
+                    if not inclusive_end and end is not None:
+                        rows = [row for row in rows if row[0] != end]
+                else:
+                    rows = index.get_range(start, end, inclusive_end)
+            if descending:
+                rows = list(reversed(rows))
+
+            skip = options.get('skip', 0)
+            rows = rows[skip:]
+            if 'limit' in options:
+                rows = rows[:options['limit']]
+
+            result_rows = []
+            for (sort_key, doc_id, key, value) in rows:
+                row = {'id': doc_id, 'key': key, 'value': value}
+                if options.get('include_docs'):
+                    row['doc'] = self.docs[doc_id]
+                result_rows.append(row)
+            return {'total_rows': len(index.rows), 'offset': skip,
+                    'rows': result_rows}
+
+    def get_changes(self, options):
+        since = int(options.get('since') or 0)
+        limit = options.get('limit')
+        doc_filter = None
+        if options.get('filter') is not None:
+            doc_filter = FILTERS.get(options['filter'])
+            if doc_filter is None:
+                raise HTTPError(404, 'not_found', 'missing filter')
+
+        results = []
+        with self.lock:
+            last_seq = since
+            for seq in sorted(seq for seq in self.changes if seq > since):
+                doc = self.docs[self.changes[seq]]
+                last_seq = seq
+                if doc_filter is not None and not doc.get('_deleted') \
+                        and not doc_filter(doc):
+                    continue
+                change = {
+                    'seq': seq,
+                    'id': doc['_id'],
+                    'changes': [{'rev': doc['_rev']}],
+                }
+                if doc.get('_deleted'):
+                    change['deleted'] = True
+                if options.get('include_docs'):
+                    change['doc'] = doc
+                results.append(change)
+                if limit is not None and len(results) >= limit:
+                    break
+        return {'results': results, 'last_seq': last_seq}
+
+    def get_info(self):
+        with self.lock:
+            count = len([doc for doc in self.docs.values()
+                         if not doc.get('_deleted')])
+            return {'db_name': self.name, 'doc_count': count,
+                    'update_seq': self.seq}
+
+    def _add_change(self, doc_id):
+        self.seq += 1
+        previous_seq = self.doc_seqs.get(doc_id)
+        if previous_seq is not None:
+            del self.changes[previous_seq]
+        self.changes[self.seq] = doc_id
+        self.doc_seqs[doc_id] = self.seq
+
+    def _save_attachments(self, doc, generation, added):
+        '''
+        Decode inline attachments, keep stubs, drop attachments missing from
+        the new revision (like CouchDB does).
+        '''
+        doc_id = doc['_id']
+        previous = self.attachments.get(doc_id, {})
+        attachments = {}
+        for (name, attachment) in (doc.get('_attachments') or {}).items():
+            if attachment.get('stub'):
+                if name not in previous:
+                    raise HTTPError(412, 'missing_stub',
+                                    'Stub without attachment')
+                attachments[name] = previous[name]
+            else:
+                added[name] = (
+                    attachment.get('content_type',
+                                   'application/octet-stream'),
+                    base64.b64decode(attachment.get('data', '')))
+
+        for (name, (content_type, data)) in added.items():
+            attachments[name] = {
+                'content_type': content_type,
+                'data': data,
+                'revpos': generation,
+                'digest': 'md5-' + base64.b64encode(
+                    hashlib.md5(data).digest()),
+            }
+
+        if attachments:
+            self.attachments[doc_id] = attachments
+            doc['_attachments'] = dict(
+                (name, {
+                    'content_type': attachment['content_type'],
+                    'length': len(attachment['data']),
+                    'revpos': attachment['revpos'],
+                    'digest': attachment['digest'],
+                    'stub': True,
+                }) for (name, attachment) in attachments.items())
+        else:
+            self.attachments.pop(doc_id, None)
+            doc.pop('_attachments', None)
+
+
+class FakeCouchDB(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server answering like CouchDB. *latency* (s) is added to every
+    request to simulate a slower or remote database. Requests are counted
+    by method.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', port), RequestHandler)
+        self.latency = latency
+        self.databases = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count_requests(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def create_db(self, name):
+        with self.lock:
+            if name in self.databases:
+                raise HTTPError(412, 'file_exists',
+                                'The database could not be created, the '
+                                'file already exists.')
+            self.databases[name] = Database(name)
+            return self.databases[name]
+
+    def get_db(self, name):
+        with self.lock:
+            db = self.databases.get(name)
+        if db is None:
+            raise HTTPError(404, 'not_found', 'no_db_file')
+        return db
+
+    def delete_db(self, name):
+        with self.lock:
+            if self.databases.pop(name, None) is None:
+                raise HTTPError(404, 'not_found', 'missing')
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Like CouchDB, answer without waiting for Nagle's algorithm:
+        # keep-alive responses would otherwise be delayed by delayed ACKs.
+        self.connection.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def do_COPY(self):
+        self._handle('COPY')
+
+    def _handle(self, method):
+        server = self.server
+        with server.lock:
+            server.requests[method] = server.requests.get(method, 0) + 1
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        url = urlparse.urlsplit(self.path)
+        parts = [urllib.unquote(part) for part in url.path.split('/') if part]
+        query = dict(urlparse.parse_qsl(url.query))
+        body = self._read_body()
+        try:
+            self._route(method, parts, query, body)
+        except HTTPError as e:
+            self._send_json(e.status, {'error': e.error, 'reason': e.reason})
+
+    def _route(self, method, parts, query, body):
+        server = self.server
+        if len(parts) == 0:
+            return self._send_json(200, {'couchdb': 'Welcome',
+                                         'version': '1.6.1'})
+        if parts == ['_all_dbs']:
+            return self._send_json(200, sorted(server.databases.keys()))
+        if parts[0] in ('_session', '_active_tasks', '_replicate'):
+            return self._send_json(200, {'ok': True})
+
+        name = parts[0]
+        if len(parts) == 1:
+            if method == 'PUT':
+                server.create_db(name)
+                return self._send_json(201, {'ok': True})
+            elif method == 'DELETE':
+                server.delete_db(name)
+                return self._send_json(200, {'ok': True})
+            elif method == 'POST':
+                doc = json.loads(body)
+                rev = server.get_db(name).save(doc)
+                return self._send_json(
+                    201, {'ok': True, 'id': doc['_id'], 'rev': rev})
+            return self._send_json(200, server.get_db(name).get_info())
+
+        db = server.get_db(name)
+        if parts[1] == '_bulk_docs':
+            return self._send_json(201, self._bulk_docs(db, json.loads(body)))
+        if parts[1] == '_changes':
+            options = self._parse_options(query)
+            return self._send_json(200, db.get_changes(options))
+        if parts[1] == '_design' and len(parts) == 5 and \
+                parts[3] == '_view':
+            options = self._parse_options(query)
+            if method == 'POST':
+                options.update(json.loads(body))
+            return self._send_json(
+                200, db.query('%s/%s' % (parts[2], parts[4]), options))
+
+        if parts[1] in ('_design', '_local'):
+            doc_id = '/'.join(parts[1:3])
+            attachment = parts[3:]
+        else:
+            doc_id = parts[1]
+            attachment = parts[2:]
+
+        if len(attachment) > 0:
+            return self._attachment(method, db, doc_id, attachment[0],
+                                    query, body)
+        if method in ('GET', 'HEAD'):
+            doc = db.get(doc_id)
+            return self._send_json(200, doc)
+        elif method == 'PUT':
+            doc = json.loads(body)
+            doc['_id'] = doc_id
+            if 'rev' in query:
+                doc['_rev'] = query['rev']
+            rev = db.save(doc)
+            return self._send_json(201, {'ok': True, 'id': doc_id,
+                                         'rev': rev})
+        elif method == 'DELETE':
+            rev = db.save({'_id': doc_id, '_rev': query.get('rev'),
+                           '_deleted': True})
+            return self._send_json(200, {'ok': True, 'id': doc_id,
+                                         'rev': rev})
+        raise HTTPError(405, 'method_not_allowed', method)
+
+    def _attachment(self, method, db, doc_id, name, query, body):
+        if method == 'PUT':
+            content_type = self.headers.get(
+                'Content-Type', 'application/octet-stream')
+            rev = db.put_attachment(doc_id, query.get('rev'), name,
+                                    content_type, body)
+            return self._send_json(201, {'ok': True, 'id': doc_id,
+                                         'rev': rev})
+
+        attachment = db.get_attachment(doc_id, name)
+        data = attachment['data']
+        headers = {'Content-Type': attachment['content_type'],
+                   'Accept-Ranges': 'bytes'}
+        status = 200
+        match = re.match(r'bytes=(\d+)-(\d*)$',
+                         self.headers.get('Range', ''))
+        if match is not None and len(data) > 0:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start > end:
+                raise HTTPError(416, 'range_not_satisfiable', 'Bad range')
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end, len(data))
+            data = data[start:end + 1]
+            status = 206
+        self._send(status, data, headers, send_body=method != 'HEAD')
+
+    def _bulk_docs(self, db, body):
+        results = []
+        for doc in body.get('docs', []):
+            try:
+                rev = db.save(doc)
+                results.append({'ok': True, 'id': doc['_id'], 'rev': rev})
+            except HTTPError as e:
+                results.append({'id': doc.get('_id'), 'error': e.error,
+                                'reason': e.reason})
+        return results
+
+    def _parse_options(self, query):
+        options = {}
+        for (key, value) in query.items():
+            try:
+                options[key] = json.loads(value)
+            except ValueError:
+                options[key] = value
+        return options
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(chunks)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data),
+                   {'Content-Type': 'application/json'})
+
+    def _send(self, status, body, headers, send_body=True):
+        self.send_response(status)
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body and self.command != 'HEAD':
+            self.wfile.write(body)
@@ -0,0 +1,284 @@
+'''
+Run file system operations of CouchFSDocument against the in-process fake
+CouchDB on synthetic trees, then print throughput, latency percentiles and
+number of HTTP requests of every phase.
+
+    python run.py [--trees wide,deep] [--threads 4] [--latency 1]
+                  [--output results.json] [--compare baseline.json]
+'''
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..'))
+
+import cozyfuse.local_config as local_config
+import cozyfuse.connection as connection
+import cozyfuse.dbutils as dbutils
+import cozyfuse.couchmount as couchmount
+
+import fakecouch
+import trees
+
+READ_SIZE = 128 * 1024
+WRITE_SIZE = 4096
+WRITTEN_FILES = 200
+WRITTEN_FILE_SIZE = 16 * 1024
+READ_FILES = 200
+COZY_URL = 'https://bench.cozy.example'
+
+
+class Benchmark:
+    '''
+    Time operations of the phases of a tree and count the HTTP requests
+    received by the fake CouchDB meanwhile.
+    '''
+
+    def __init__(self, server, threads=1):
+        self.server = server
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.results = []
+
+    def run_phase(self, phase, operations):
+        '''
+        Run every operation (a function without argument) and record its
+        latency. Operations returning a negative error code are counted as
+        errors.
+        '''
+        def timed(operation):
+            start = time.time()
+            result = operation()
+            return (time.time() - start,
+                    isinstance(result, int) and result < 0)
+
+        requests = self.server.count_requests()
+        start = time.time()
+        if self.threads > 1:
+            timings = self.pool.map(timed, operations, chunksize=1)
+        else:
+            timings = [timed(operation) for operation in operations]
+        duration = time.time() - start
+        requests = self.server.count_requests() - requests
+
+        latencies = sorted(timing[0] for timing in timings)
+        result = {
+            'phase': phase,
+            'ops': len(latencies),
+            'errors': len([timing for timing in timings if timing[1]]),
+            'duration': duration,
+            'ops_per_second': len(latencies) / max(duration, 1e-9),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0,
+            'requests': requests,
+        }
+        self.results.append(result)
+        return result
+
+
+def percentile(values, ratio):
+    '''
+    Return the value below which *ratio* of sorted values fall.
+    '''
+    if len(values) == 0:
+        return 0
+    index = max(int(math.ceil(ratio * len(values))) - 1, 0)
+    return values[index]
+
+
+def read_file(fs, path):
+    fh = fs.open(path, os.O_RDONLY)
+    if isinstance(fh, int):
+        return fh
+    offset = 0
+    while True:
+        data = fs.read(path, READ_SIZE, offset, fh)
+        if isinstance(data, int):
+            fs.release(path, os.O_RDONLY, fh)
+            return data
+        offset += len(data)
+        if len(data) < READ_SIZE:
+            break
+    return fs.release(path, os.O_RDONLY, fh)
+
+
+def write_file(fs, path):
+    result = fs.mknod(path, 0o100644, 0)
+    if result != 0:
+        return result
+    fh = fs.open(path, os.O_WRONLY)
+    if isinstance(fh, int):
+        return fh
+    data = 'x' * WRITE_SIZE
+    for offset in range(0, WRITTEN_FILE_SIZE, WRITE_SIZE):
+        fs.write(path, data, offset, fh)
+    return fs.release(path, os.O_WRONLY, fh)
+
+
+def run_tree(server, name, entries, threads):
+    '''
+    Load tree in a new database and run every phase on it.
+    '''
+    device = 'bench-%s' % name.replace('_', '-')
+    mountpoint = os.path.join(local_config.CONFIG_FOLDER, 'mount', device)
+    db = server.create_db(device)
+    dbutils.init_database_views(device)
+    db.save({'docType': 'Device', 'login': device, 'url': COZY_URL,
+             'password': 'password'})
+    local_config.add_config(device, COZY_URL, mountpoint, device, 'password')
+    trees.load(db, entries)
+
+    folders = [''] + trees.get_paths(entries, 'folder')
+    files = trees.get_paths(entries, 'file')
+    paths = folders + files
+    read_files = files[:READ_FILES]
+    parent = folders[-1]
+    written = ['%s/written-%03d.txt' % (parent, i)
+               for i in range(WRITTEN_FILES)]
+    renamed = [path + '.renamed' for path in written]
+
+    fs = couchmount.CouchFSDocument(
+        device, mountpoint, uri=connection.get_url(device), threads=threads)
+    benchmark = Benchmark(server, threads)
+    try:
+        benchmark.run_phase(
+            'index sync', [lambda: fs.index.sync(fs.db)])
+        benchmark.run_phase(
+            'getattr cold', [lambda p=p: fs.getattr(p) for p in paths])
+        benchmark.run_phase(
+            'getattr warm', [lambda p=p: fs.getattr(p) for p in paths])
+        benchmark.run_phase(
+            'readdir', [lambda p=p: list(fs.readdir(p, 0)) for p in folders])
+        benchmark.run_phase(
+            'read cold', [lambda p=p: read_file(fs, p) for p in read_files])
+        benchmark.run_phase(
+            'read warm', [lambda p=p: read_file(fs, p) for p in read_files])
+        benchmark.run_phase(
+            'write', [lambda p=p: write_file(fs, p) for p in written])
+        benchmark.run_phase('upload', [fs.writeback.join])
+        benchmark.run_phase(
+            'rename', [lambda p=p, q=q: fs.rename(p, q)
+                       for (p, q) in zip(written, renamed)])
+        benchmark.run_phase(
+            'unlink', [lambda p=p: fs.unlink(p) for p in renamed])
+    finally:
+        fs.fsdestroy()
+        benchmark.pool.close()
+        connection.close(device)
+        server.delete_db(device)
+    return benchmark.results
+
+
+def print_report(results, baseline=None):
+    '''
+    Print results as a table. If baseline results are given, variations of
+    throughput and of the 99th percentile are displayed.
+    '''
+    header = '%-12s %-13s %6s %5s %10s %9s %9s %9s %9s %8s' % (
+        'tree', 'phase', 'ops', 'err', 'ops/s', 'p50 ms', 'p95 ms',
+        'p99 ms', 'max ms', 'req/op')
+    if baseline is not None:
+        header += ' %8s %8s' % ('d ops/s', 'd p99')
+    print header
+    print '-' * len(header)
+
+    for (tree, phases) in results:
+        baseline_phases = dict(
+            (phase['phase'], phase)
+            for phase in dict(baseline or []).get(tree, []))
+        for phase in phases:
+            line = '%-12s %-13s %6d %5d %10.1f %9.2f %9.2f %9.2f %9.2f ' \
+                '%8.2f' % (
+                    tree, phase['phase'], phase['ops'], phase['errors'],
+                    phase['ops_per_second'], phase['p50'] * 1000,
+                    phase['p95'] * 1000, phase['p99'] * 1000,
+                    phase['max'] * 1000,
+                    float(phase['requests']) / max(phase['ops'], 1))
+            reference = baseline_phases.get(phase['phase'])
+            if reference is not None:
+                line += ' %8s %8s' % (
+                    variation(phase['ops_per_second'],
+                              reference['ops_per_second']),
+                    variation(phase['p99'], reference['p99']))
+            print line
+
+
+def variation(value, reference):
+    if reference == 0:
+        return 'n/a'
+    return '%+.0f%%' % ((value - reference) * 100.0 / reference)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--trees', default=','.join(name for (name, tree) in trees.TREES),
+        help='Comma separated list of trees to benchmark')
+    parser.add_argument(
+        '--scale', type=float, default=1,
+        help='Multiply the number and the size of files of every tree')
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help='Number of threads running operations (like a multithreaded '
+             'mount)')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Delay (ms) added to every request made to the fake CouchDB')
+    parser.add_argument(
+        '--output', help='Save results to given JSON file')
+    parser.add_argument(
+        '--compare', help='Compare results to given JSON file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    # Configuration, caches and mount points go in a temporary folder.
+    config_folder = tempfile.mkdtemp(prefix='cozyfuse-bench-')
+    local_config.CONFIG_FOLDER = config_folder
+    local_config.CONFIG_PATH = os.path.join(config_folder, 'config.yaml')
+    couchmount.CONFIG_FOLDER = config_folder
+
+    server = fakecouch.FakeCouchDB(latency=args.latency / 1000.0).start()
+    connection.COUCHDB_URL = server.url
+
+    results = []
+    try:
+        selected = args.trees.split(',')
+        for (name, tree) in trees.TREES:
+            if name in selected:
+                print >> sys.stderr, 'Benchmarking %s tree...' % name
+                results.append((name, run_tree(
+                    server, name, tree(args.scale), args.threads)))
+    finally:
+        server.stop()
+        shutil.rmtree(config_folder, ignore_errors=True)
+
+    print_report(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(),
+                'scale': args.scale,
+                'threads': args.threads,
+                'latency': args.latency,
+                'results': results,
+            }, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
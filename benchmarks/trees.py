@@ -0,0 +1,111 @@
+'''
+Synthetic file trees loaded directly in the fake CouchDB. A tree is a list
+of ('folder', path) and ('file', path, size) entries, parents are always
+listed before their children.
+'''
+import random
+import mimetypes
+
+BLOCK_SIZE = 1024 * 1024
+DATE = '2015-01-01T00:00:00'
+
+
+def wide(scale=1):
+    '''
+    A single folder containing many small files.
+    '''
+    entries = [('folder', '/wide')]
+    for i in range(int(5000 * scale)):
+        entries.append(('file', '/wide/file-%05d.txt' % i, 1024))
+    return entries
+
+
+def deep(scale=1):
+    '''
+    A long chain of nested folders with a few files at every level.
+    '''
+    entries = []
+    path = ''
+    for level in range(int(40 * scale)):
+        path = '%s/level-%02d' % (path, level)
+        entries.append(('folder', path))
+        for i in range(10):
+            entries.append(('file', '%s/file-%d.txt' % (path, i), 4096))
+    return entries
+
+
+def small_files(scale=1):
+    '''
+    Many folders of small files of various sizes, like a source tree.
+    '''
+    generator = random.Random(0)
+    entries = [('folder', '/src')]
+    for folder in range(int(50 * scale)):
+        path = '/src/module-%02d' % folder
+        entries.append(('folder', path))
+        for i in range(100):
+            entries.append(('file', '%s/file-%03d.py' % (path, i),
+                            generator.randint(512, 16 * 1024)))
+    return entries
+
+
+def huge_files(scale=1):
+    '''
+    A few big files.
+    '''
+    entries = [('folder', '/huge')]
+    for i in range(3):
+        entries.append(('file', '/huge/file-%d.bin' % i,
+                        int(32 * BLOCK_SIZE * scale)))
+    return entries
+
+
+TREES = [
+    ('wide', wide),
+    ('deep', deep),
+    ('small_files', small_files),
+    ('huge_files', huge_files),
+]
+
+
+def load(db, entries, seed=0):
+    '''
+    Create folder, file and binary documents of given entries in fake
+    database *db*. Binaries are filled with pseudo-random data.
+    '''
+    generator = random.Random(seed)
+    block = ''.join(chr(generator.randint(0, 255))
+                    for i in range(BLOCK_SIZE))
+
+    for entry in entries:
+        (path, name) = entry[1].rsplit('/', 1)
+        doc = {
+            'name': name,
+            'path': path,
+            'creationDate': DATE,
+            'lastModification': DATE,
+        }
+        if entry[0] == 'folder':
+            doc['docType'] = 'Folder'
+            db.save(doc)
+        else:
+            size = entry[2]
+            data = (block * (size // BLOCK_SIZE + 1))[:size]
+            (mime_type, encoding) = mimetypes.guess_type(name)
+            binary = {'docType': 'Binary'}
+            rev = db.save(binary, {
+                'file': (mime_type or 'application/octet-stream', data)})
+            doc.update({
+                'docType': 'File',
+                'size': size,
+                'mime': mime_type,
+                'binary': {'file': {'id': binary['_id'], 'rev': rev}},
+            })
+            db.save(doc)
+
+
+def get_paths(entries, entry_type):
+    '''
+    Return paths of entries of given type ('folder' or 'file').
+    '''
+    return [entry[1] for entry in entries if entry[0] == entry_type]
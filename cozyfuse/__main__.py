@@ -99,6 +99,19 @@ def main(argv=sys.argv):
         nargs='*',
         help='Name of synchronized devices to mount'
     ).completer = DeviceCompleter
+    parser_mount.add_argument(
+        '-t', '--threads',
+        type=int,
+        default=1,
+        help='Number of threads serving file system requests'
+    )
+    parser_mount.add_argument(
+        '-w', '--folder-update-window',
+        type=float,
+        default=2,
+        help='Delay (in seconds) during which last modification updates of'
+             ' a folder are coalesced'
+    )
 
     # "unmount" action
     parser_unmount = subparsers.add_parser(
@@ -149,6 +162,32 @@ def main(argv=sys.argv):
     )
     parser_display_conf.set_defaults(func=actions.display_config)
 
+    # "stats" action
+    parser_stats = subparsers.add_parser(
+        'stats',
+        help='Display operation latencies and cache hit ratios of a'
+             ' mounted device.'
+    )
+    parser_stats.set_defaults(func=actions.display_stats)
+
+    parser_stats.add_argument(
+        'device',
+        help='Name of the mounted device'
+    ).completer = DeviceCompleter
+
+    # "progress" action
+    parser_progress = subparsers.add_parser(
+        'progress',
+        help='Display number and size of synchronized and stored files.'
+    )
+    parser_progress.set_defaults(func=actions.display_progress)
+
+    parser_progress.add_argument(
+        'devices',
+        nargs='*',
+        help='Name of the devices (all by default)'
+    ).completer = DeviceCompleter
+
     # "remove_config" action
     parser_rmconf = subparsers.add_parser(
         'remove_config',
@@ -197,6 +236,12 @@ def main(argv=sys.argv):
         'path',
         help='Path of folder to cache'
     )
+    parser_cache_folder.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=actions.CACHE_JOBS,
+        help='Number of files downloaded at the same time'
+    )
     parser_cache_folder.set_defaults(func=actions.cache_folder)
 
     # "cache_file" action
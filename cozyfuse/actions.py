@@ -2,8 +2,8 @@ import os
 import sys
 import errno
 import getpass
-import requests
 import json
+import threading
 import binarycache
 
 import couchmount
@@ -11,8 +11,14 @@ import replication
 import local_config
 import remote
 import dbutils
+import fusepath
+import connection
+import transfers
 
-from couchdb import Server
+from multiprocessing.pool import ThreadPool
+
+# Number of files downloaded at the same time by cache_folder.
+CACHE_JOBS = 4
 
 
 def query_yes_no(question, default='yes'):
@@ -112,7 +118,8 @@ def kill_running_replications():
     Useful when a replication is in Zombie mode.
     '''
 
-    server = Server('http://localhost:5984/')
+    server = connection.get_server()
+    session = connection.get_session()
 
     for task in server.tasks():
         data = {
@@ -120,8 +127,8 @@ def kill_running_replications():
             "cancel": True
         }
         headers = {'content-type': 'application/json'}
-        response = requests.post('http://localhost:5984/_replicate',
-                                 json.dumps(data), headers=headers)
+        response = session.post('http://localhost:5984/_replicate',
+                                json.dumps(data), headers=headers)
         if response.status_code == 200:
             print 'Replication %s stopped.' % data['replication_id']
         else:
@@ -177,9 +184,11 @@ def reset():
     print '[reset] Configuration files deleted, folder unmounted.'
 
 
-def mount_folder(devices=[]):
+def mount_folder(devices=[], threads=1, folder_update_window=2):
     '''
-    Mount folder linked to given device.
+    Mount folder linked to given device. *threads* is the number of threads
+    allowed to serve file system requests. *folder_update_window* is the
+    delay (s) during which folder modification dates are coalesced.
     '''
     if len(devices) == 0:
         devices = local_config.get_default_devices()
@@ -200,7 +209,7 @@ def mount_folder(devices=[]):
                     pass
                 else:
                     continue
-            couchmount.mount(name, path)
+            couchmount.mount(name, path, threads, folder_update_window)
         except KeyboardInterrupt:
             unmount_folder(name)
 
@@ -261,14 +270,14 @@ def cache_file(device, path, add=True):
     device_mount_path_len = len(device_mount_path)
     device_config_path = os.path.join(local_config.CONFIG_FOLDER, device)
     path = abs_path[device_mount_path_len:]
-    path = couchmount._normalize_path(path)
+    path = fusepath.normalize_path(path)
 
     print "Start %s caching." % abs_path
     if abs_path[:device_mount_path_len] == device_mount_path:
         binary_cache = binarycache.BinaryCache(
             device, device_config_path, device_url, device_mount_path)
         if add:
-            binary_cache.add(path)
+            binary_cache.add(path, priority=transfers.PREFETCH)
             print "File %s successfully cached." % abs_path
         else:
             binary_cache.remove(path)
@@ -285,9 +294,12 @@ def uncache_file(device, path):
     cache_file(device, path, False)
 
 
-def cache_folder(device, path, add=True):
+def cache_folder(device, path, add=True, jobs=CACHE_JOBS):
     '''
-    Download target file from remote Cozy to local folder.
+    Download binaries of files located in target folder (and its subfolders)
+    from remote Cozy to local cache. File list is read from the database,
+    binaries are downloaded by *jobs* parallel workers. Already cached files
+    are skipped, so an interrupted caching can simply be run again.
     '''
 
     # Get configuration.
@@ -317,21 +329,48 @@ def cache_folder(device, path, add=True):
 
         # Cache object
         binary_cache = binarycache.BinaryCache(
-            device, device_config_path, device_url, device_mount_path)
-
-        # Walk through given folder and run cache operation on each file found.
-        for (dirpath, dirnames, filenames) in os.walk(abs_path):
-            for filename in filenames:
-                file_path = os.path.join(dirpath, filename)
-                file_path = file_path[device_mount_path_len:]
-                file_path = couchmount._normalize_path(file_path)
-
+            device, device_config_path, device_url, device_mount_path,
+            max_downloads=jobs)
+
+        # List files from the database instead of walking through the mount.
+        folder_path = fusepath.normalize_path(
+            abs_path[device_mount_path_len:])
+        file_docs = [
+            file_doc for file_doc in dbutils.get_files_in_folder(
+                binary_cache.db, folder_path)
+            if file_doc.get('binary') is not None
+        ]
+        file_paths = [fusepath.join(file_doc['path'], file_doc['name'])
+                      for file_doc in file_docs]
+        print "%d files found (%.1f MB)." % (
+            len(file_docs),
+            sum(file_doc.get('size') or 0 for file_doc in file_docs) / 1e6)
+
+        progress = {'done': 0, 'total': len(file_paths)}
+        progress_lock = threading.Lock()
+
+        def run_cache_operation(file_path):
+            try:
                 if add:
-                    binary_cache.add(file_path)
-                    print "File %s successfully cached." % file_path
+                    binary_cache.fetch(file_path, transfers.PREFETCH)
+                    message = "File %s successfully cached." % file_path
                 else:
                     binary_cache.remove(file_path)
-                    print "File %s successfully uncached." % file_path
+                    message = "File %s successfully uncached." % file_path
+            except Exception as e:
+                message = "File %s failed: %s" % (file_path, e)
+
+            with progress_lock:
+                progress['done'] += 1
+                print "[%d/%d] %s" % (
+                    progress['done'], progress['total'], message)
+
+        pool = ThreadPool(max(1, jobs))
+        try:
+            pool.map(run_cache_operation, file_paths)
+        finally:
+            pool.close()
+            pool.join()
     else:
         print 'This is not a folder synchronized with your Cozy'
 
@@ -355,6 +394,36 @@ def display_config():
         print ' '
 
 
+def display_stats(device):
+    '''
+    Display metrics written by the mount process of given device.
+    '''
+    filename = os.path.join(
+        local_config.CONFIG_FOLDER, device, 'metrics.prom')
+    if not os.path.isfile(filename):
+        print 'No metrics found for device %s, is it mounted?' % device
+        sys.exit(1)
+    with open(filename, 'r') as metrics_file:
+        sys.stdout.write(metrics_file.read())
+
+
+def display_progress(devices=[]):
+    '''
+    Display synchronization progress of given devices.
+    '''
+    if len(devices) == 0:
+        devices = local_config.get_full_config().keys()
+
+    for name in devices:
+        progress = replication.get_progress(name)
+        print '%s:' % name
+        print '- Files: %d' % progress['files']
+        print '- Binaries downloaded: %d' % progress['binaries']
+        print '- Total size: %.1f MB' % (progress['bytes'] / 1e6)
+        print '- Size stored on this device: %.1f MB' % \
+            (progress['bytes_cached'] / 1e6)
+
+
 def unregister_device(device):
     '''
     Remove device from local configuration, destroy corresponding database
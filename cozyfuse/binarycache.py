@@ -1,16 +1,37 @@
 import os
+import Queue
+import uuid
 import shutil
-import requests
+import weakref
+import threading
 import exceptions
 
 import dbutils
 import cache
+import connection
+import metrics
+import transfers
 
 import logging
 import local_config
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
+# Binaries read without being cached are downloaded by blocks of BLOCK_SIZE
+# bytes. READAHEAD is the number of blocks fetched after the requested ones.
+BLOCK_SIZE = 1024 * 1024
+READAHEAD = 4
+
+# Number of blocks requested at once when a prepared file is entirely
+# downloaded.
+FILL_BLOCKS = 16
+
+# Size of data chunks read from the network and of the buffer used to write
+# them to disk.
+CHUNK_SIZE = 1024 * 1024
+
+# Ask CouchDB for raw data, ranges do not apply to compressed attachments.
+IDENTITY_HEADERS = {'Accept-Encoding': 'identity'}
 
 
 class BinaryCache:
@@ -19,9 +40,16 @@ class BinaryCache:
     '''
 
     def __init__(self,
-                 name, device_config_path, remote_url, device_mount_path):
+                 name, device_config_path, remote_url, device_mount_path,
+                 max_downloads=1, block_size=BLOCK_SIZE, readahead=READAHEAD,
+                 chunk_size=CHUNK_SIZE):
         '''
         Register information required to handle caching.
+        *max_downloads* is the number of binaries that can be downloaded at
+        the same time when the cache is shared by several threads, downloads
+        are scheduled by priority.
+        *block_size* and *readahead* configure partial downloads.
+        *chunk_size* is the size of data chunks written to the cache.
         '''
         self.name = name
         self.device_config_path = device_config_path
@@ -31,6 +59,30 @@ class BinaryCache:
         self.cache_path = os.path.join(device_config_path, 'cache')
         self.db = dbutils.get_db(self.name)
         self.metadata_cache = cache.Cache()
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self._block_maps = {}
+
+        # HTTP connections of the device are kept alive and shared by
+        # downloads.
+        self.session = connection.get_connections(
+            name, pool_size=max_downloads).session
+
+        # Downloads are limited to max_downloads and a binary is never
+        # fetched twice at the same time. Interactive downloads hold back
+        # background transfers of other processes of the device.
+        self.transfers = transfers.TransferScheduler(
+            max_downloads,
+            activity_file=os.path.join(
+                device_config_path, transfers.ACTIVITY_FILE))
+        # Locks are forgotten once no thread uses them.
+        self._binary_locks = weakref.WeakValueDictionary()
+        self._binary_locks_lock = threading.Lock()
+
+        # Cache folders of deleted files are removed in background.
+        self._purge_queue = None
+        self._purge_queue_lock = threading.Lock()
 
         if not os.path.isdir(self.cache_path):
             os.makedirs(self.cache_path)
@@ -52,6 +104,33 @@ class BinaryCache:
             self.metadata_cache.add(path, res)
         return res
 
+    def get_binary_lock(self, binary_id):
+        '''
+        Return the lock that serializes cache operations on given binary.
+        '''
+        with self._binary_locks_lock:
+            lock = self._binary_locks.get(binary_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._binary_locks[binary_id] = lock
+            return lock
+
+    def fetch(self, path, priority=transfers.INTERACTIVE):
+        '''
+        Download the binary of file located at path unless it is already
+        cached. When several threads require the same binary, only the first
+        one downloads it, the others wait for it.
+        '''
+        if not self.is_cached(path):
+            self.add(path, priority=priority)
+
+    def get_cached_file(self, binary_id):
+        '''
+        Return name and size of the cached file of given binary.
+        '''
+        filename = os.path.join(self.cache_path, binary_id, 'file')
+        return (filename, os.path.getsize(filename))
+
     def get_current_size(self, path):
         '''
         Return size of cached file.
@@ -61,11 +140,112 @@ class BinaryCache:
 
     def is_cached(self, path):
         '''
-        Returns True is the file is already present in the cache folder.
+        Returns True is the file is already fully present in the cache folder.
+        A file which has a block map is only partially downloaded.
         '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
 
-        return os.path.exists(filename)
+        return os.path.exists(filename) and \
+            not os.path.exists(self._get_block_map_name(binary_id))
+
+    def prepare(self, path):
+        '''
+        Make file readable without downloading its binary: create a sparse
+        cache file of the binary size along with an empty block map. Blocks
+        are then downloaded on demand by fetch_range. When the binary size
+        is not given by CouchDB, the size of the file document is used, or
+        the binary is entirely downloaded if the document has none.
+        '''
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        if not self._prepare(file_doc, binary_id, filename):
+            self.fetch(path)
+
+    def _prepare(self, file_doc, binary_id, filename):
+        '''
+        Create sparse cache file and block map. Return False if the binary
+        size is unknown.
+        '''
+        with self.get_binary_lock(binary_id):
+            if os.path.exists(filename):
+                return True
+
+            url = self._get_binary_url(binary_id)
+            req = self.session.head(url, headers=IDENTITY_HEADERS)
+            if req.status_code != 200:
+                raise exceptions.IOError(
+                    "File not stored in the local CouchDB database %s" % url)
+            size = req.headers.get('content-length')
+            if size is None:
+                size = file_doc.get('size')
+            if size is None:
+                return False
+            size = int(size)
+
+            cache_file_folder = os.path.join(self.cache_path, binary_id)
+            if not os.path.isdir(cache_file_folder):
+                os.mkdir(cache_file_folder)
+
+            # The block map is written first, this way an interrupted
+            # preparation never looks like a cached file.
+            if size > 0:
+                block_map = bytearray(
+                    (size + self.block_size - 1) // self.block_size)
+                self._save_block_map(binary_id, block_map)
+            with open(filename, 'wb') as fd:
+                fd.truncate(size)
+
+            if size == 0:
+                self.mark_file_as_stored(file_doc)
+            return True
+
+    def fetch_range(self, path, offset, length):
+        '''
+        Ensure that bytes from offset to offset + length of a prepared file
+        are present in the cache. Missing blocks are downloaded with HTTP
+        range requests, followed by readahead blocks. When the last missing
+        block is downloaded the file is marked as stored.
+        Return True if the binary is fully cached.
+        '''
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        first = offset // self.block_size
+        last = (offset + max(length, 1) - 1) // self.block_size
+        return self.transfers.run(
+            (binary_id, first, last),
+            lambda transfer: self._fetch_blocks(
+                file_doc, binary_id, filename, first, last),
+            transfers.INTERACTIVE)
+
+    def _fetch_blocks(self, file_doc, binary_id, filename, first, last):
+        '''
+        Download missing blocks from first to last (plus readahead) of a
+        prepared file. Like every transfer, it takes the binary lock once it
+        got its download slot.
+        '''
+        with self.get_binary_lock(binary_id):
+            block_map = self._load_block_map(binary_id)
+            if block_map is None:
+                return True
+
+            last = min(last + self.readahead, len(block_map) - 1)
+
+            start = None
+            for block in range(first, last + 2):
+                missing = block <= last and block_map[block] == 0
+                if missing and start is None:
+                    start = block
+                elif not missing and start is not None:
+                    self._download_blocks(
+                        binary_id, filename, block_map, start, block - 1)
+                    start = None
+
+            if all(block_map):
+                self._drop_block_map(binary_id)
+                file_doc['size'] = os.path.getsize(filename)
+                self.mark_file_as_stored(file_doc)
+                return True
+            else:
+                self._save_block_map(binary_id, block_map)
+                return False
 
     def get(self, path, mode='r'):
         '''
@@ -75,39 +255,52 @@ class BinaryCache:
 
         return open(filename, mode)
 
-    def add(self, path, data=None):
+    @metrics.timed('cozyfuse_binary_cache', 'call')
+    def add(self, path, data=None, priority=transfers.INTERACTIVE):
         '''
         If no data is given, it downloads the binary from configured CouchDB
         and save it in the cache folder. File is marked as stored in the file
-        metadata.
+        metadata. The download waits for transfers of higher *priority*.
         If data is given, it creates a new binary with that data but don't
         upload anything in CouchDB.
+        Downloaded data are written to a temporary file which is renamed once
+        complete, an interrupted download is never considered as cached.
         '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
         cache_file_folder = os.path.join(self.cache_path, binary_id)
-        logger.info('binay_cache.add: %s %s' % (path, filename))
+        logger.info('binay_cache.add: %s %s', path, filename)
 
         # Create cache folder for given binary
-        if not os.path.isdir(cache_file_folder):
+        try:
             os.mkdir(cache_file_folder)
+        except OSError:
+            if not os.path.isdir(cache_file_folder):
+                raise
 
         # Create file.
         if data is not None:
             with open(filename, 'wb') as fd:
                 fd.write(data)
+            self._drop_block_map(binary_id)
         else:
-            url = '%s/%s/%s' % (self.remote_url, binary_id, 'file')
-            req = requests.get(url, stream=True)
-            if req.status_code != 200:
-                raise exceptions.IOError(
-                    "File not stored in the local CouchDB database %s" % url)
-            else:
-                with open(filename, 'wb') as fd:
-                    for chunk in req.iter_content(1024):
-                        fd.write(chunk)
+            start = cache.clock()
+            # Requests of the same binary share the download.
+            size = self.transfers.run(
+                binary_id,
+                lambda transfer: self._download_binary(
+                    path, binary_id, filename, transfer),
+                priority)
+            if size is None:
+                return
+
+            duration = max(cache.clock() - start, 0.001)
+            logger.info('binary_cache.add: %s downloaded, %d bytes in '
+                        '%.2fs (%.2f MB/s)',
+                        path, size, duration, size / duration / 1e6)
+            metrics.increment('cozyfuse_downloaded_bytes', size)
 
             # Update metadata.
-            file_doc['size'] = os.path.getsize(filename)
+            file_doc['size'] = size
             self.mark_file_as_stored(file_doc)
 
     def update_size(self, path):
@@ -116,7 +309,7 @@ class BinaryCache:
         information from the binary.
         '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
-        logger.info('update_size: %s' % path)
+        logger.debug('update_size: %s', path)
         file_doc['size'] = os.path.getsize(filename)
         dbutils.update_file(self.db, file_doc)
         self.metadata_cache.add(path, (file_doc, binary_id, filename))
@@ -127,9 +320,9 @@ class BinaryCache:
         Write on the cached binary of file located at path in the virtual file
         system. Offset is where the writing should start.
         '''
-        logger.info('binary_cache.update: %s' % path)
+        logger.debug('binary_cache.update: %s', path)
         with self.get(path, mode) as binary:
-            logger.info('binary_cache.update: %s' % binary)
+            logger.debug('binary_cache.update: %s', binary)
             binary.write(data)
 
     def remove(self, path):
@@ -141,9 +334,38 @@ class BinaryCache:
         cache_file_folder = os.path.join(self.cache_path, binary_id)
         if os.path.exists(cache_file_folder):
             shutil.rmtree(cache_file_folder)
+        self._block_maps.pop(binary_id, None)
         self.metadata_cache.remove(path)
         self.mark_file_as_not_stored(file_doc)
 
+    def discard(self, path, file_doc):
+        '''
+        Forget the cached binary of a deleted file. Its cache folder is
+        removed in background and, since the file document is deleted, the
+        storage list is not updated.
+        '''
+        self.metadata_cache.remove(path)
+        binary = (file_doc.get('binary') or {}).get('file')
+        if binary is None:
+            return
+
+        binary_id = binary['id']
+        self._block_maps.pop(binary_id, None)
+        with self._purge_queue_lock:
+            if self._purge_queue is None:
+                self._purge_queue = Queue.Queue()
+                thread = threading.Thread(target=self._purge)
+                thread.daemon = True
+                thread.start()
+        self._purge_queue.put(binary_id)
+
+    def join(self):
+        '''
+        Wait until cache folders of discarded binaries are removed.
+        '''
+        if self._purge_queue is not None:
+            self._purge_queue.join()
+
     def mark_file_as_stored(self, file_doc):
         '''
         Mark file as stored in the database. It's done by adding the device
@@ -166,3 +388,167 @@ class BinaryCache:
             file_doc['storage'].remove(self.name)
 
         dbutils.update_file(self.db, file_doc)
+
+    def _purge(self):
+        while True:
+            binary_id = self._purge_queue.get()
+            try:
+                with self.get_binary_lock(binary_id):
+                    shutil.rmtree(os.path.join(self.cache_path, binary_id),
+                                  ignore_errors=True)
+            finally:
+                self._purge_queue.task_done()
+
+    def _get_binary_url(self, binary_id):
+        return '%s/%s/%s' % (self.remote_url, binary_id, 'file')
+
+    def _get_block_map_name(self, binary_id):
+        return os.path.join(self.cache_path, binary_id, 'blocks')
+
+    def _load_block_map(self, binary_id):
+        '''
+        Return block map of given binary (one byte per block, set to 1 when
+        the block is downloaded). None means that the binary is complete.
+        '''
+        block_map = self._block_maps.get(binary_id)
+        if block_map is None:
+            try:
+                with open(self._get_block_map_name(binary_id), 'rb') as fd:
+                    block_map = bytearray(fd.read())
+            except IOError:
+                return None
+            self._block_maps[binary_id] = block_map
+        return block_map
+
+    def _save_block_map(self, binary_id, block_map):
+        self._block_maps[binary_id] = block_map
+        with open(self._get_block_map_name(binary_id), 'wb') as fd:
+            fd.write(block_map)
+
+    def _drop_block_map(self, binary_id):
+        self._block_maps.pop(binary_id, None)
+        block_map_name = self._get_block_map_name(binary_id)
+        if os.path.exists(block_map_name):
+            os.remove(block_map_name)
+
+    def _download_binary(self, path, binary_id, filename, transfer):
+        '''
+        Download binary into a temporary file of its own, then move it to
+        filename. The binary lock is only taken for the move, so a transfer
+        paused for a higher priority one never holds it. A prepared file may
+        be open for partial reads, its missing blocks are written in place
+        instead: its inode is never replaced.
+        Return downloaded size, None if the binary got cached meanwhile.
+        '''
+        if self.is_cached(path):
+            return None
+        if self._load_block_map(binary_id) is not None:
+            return self._fill_blocks(binary_id, filename, transfer)
+
+        tmp_filename = '%s.%s.part' % (filename, uuid.uuid4().hex)
+        size = self._download(
+            self._get_binary_url(binary_id), tmp_filename, transfer)
+        with self.get_binary_lock(binary_id):
+            if os.path.exists(filename):
+                # Prepared in the meantime.
+                self._copy_into(tmp_filename, filename)
+                os.remove(tmp_filename)
+            else:
+                os.rename(tmp_filename, filename)
+            self._drop_block_map(binary_id)
+        return size
+
+    def _fill_blocks(self, binary_id, filename, transfer):
+        '''
+        Download missing blocks of a prepared file in place, FILL_BLOCKS
+        blocks at a time. The binary lock is released between two requests,
+        where the transfer can pause. Return the binary size.
+        '''
+        while True:
+            with self.get_binary_lock(binary_id):
+                block_map = self._load_block_map(binary_id)
+                if block_map is None:
+                    return os.path.getsize(filename)
+                if all(block_map):
+                    self._drop_block_map(binary_id)
+                    return os.path.getsize(filename)
+
+                first = block_map.index(b'\x00')
+                last = first
+                while last + 1 < len(block_map) and \
+                        last + 1 - first < FILL_BLOCKS and \
+                        block_map[last + 1] == 0:
+                    last += 1
+                self._download_blocks(
+                    binary_id, filename, block_map, first, last)
+                self._save_block_map(binary_id, block_map)
+            transfer.checkpoint()
+
+    def _copy_into(self, source, filename):
+        '''
+        Overwrite filename with the content of source, keeping its inode.
+        '''
+        with open(source, 'rb') as source_fd:
+            with open(filename, 'r+b', self.chunk_size) as fd:
+                while True:
+                    chunk = source_fd.read(self.chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    fd.write(chunk)
+                fd.truncate()
+
+    def _download(self, url, filename, transfer):
+        '''
+        Write binary into filename, preallocated when the size is known.
+        Between two chunks, the download pauses if a transfer of higher
+        priority is waiting. Return written size.
+        '''
+        req = self.session.get(url, headers=IDENTITY_HEADERS, stream=True)
+        if req.status_code != 200:
+            raise exceptions.IOError(
+                "File not stored in the local CouchDB database %s" % url)
+        try:
+            with open(filename, 'wb', self.chunk_size) as fd:
+                length = req.headers.get('content-length')
+                if length is not None:
+                    fd.truncate(int(length))
+                for chunk in req.iter_content(self.chunk_size):
+                    fd.write(chunk)
+                    transfer.checkpoint()
+                size = fd.tell()
+                fd.truncate(size)
+        except:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+        return size
+
+    def _download_blocks(self, binary_id, filename, block_map, first, last):
+        '''
+        Download blocks from first to last (included) and write them at their
+        place in the cache file. If the server does not support ranges, the
+        whole binary is written.
+        '''
+        url = self._get_binary_url(binary_id)
+        headers = dict(IDENTITY_HEADERS)
+        start = first * self.block_size
+        headers['Range'] = 'bytes=%d-%d' % (
+            start, (last + 1) * self.block_size - 1)
+
+        req = self.session.get(url, headers=headers, stream=True)
+        if req.status_code == 206:
+            blocks = range(first, last + 1)
+        elif req.status_code == 200:
+            start = 0
+            blocks = range(len(block_map))
+        else:
+            raise exceptions.IOError(
+                "File not stored in the local CouchDB database %s" % url)
+
+        with open(filename, 'r+b', self.chunk_size) as fd:
+            fd.seek(start)
+            for chunk in req.iter_content(self.chunk_size):
+                fd.write(chunk)
+
+        for block in blocks:
+            block_map[block] = 1
@@ -1,48 +1,217 @@
+import os
+import sys
+import collections
 import datetime
+import threading
+import time
+import weakref
 
 VALIDITY_PERIOD = datetime.timedelta(seconds=30)
+MAX_SIZE = 10000
+PURGE_INTERVAL = 10
+
+
+def _get_linux_clock():
+    '''
+    Return a function calling clock_gettime(CLOCK_MONOTONIC) through ctypes,
+    it has the resolution needed to time operations.
+    '''
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    library = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+    clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        spec = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    monotonic()
+    return monotonic
+
+
+def _get_clock():
+    '''
+    Return a monotonic clock, so expiration and timings do not follow wall
+    clock changes. Python 2 has no time.monotonic: on Linux clock_gettime is
+    called directly, on other POSIX systems the elapsed time of os.times is
+    counted from a fixed point in the past with a 10 ms resolution, which is
+    enough for validity periods. Other systems fall back on wall clock time.
+    '''
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform.startswith('linux'):
+        try:
+            return _get_linux_clock()
+        except (ImportError, OSError, AttributeError, TypeError):
+            pass
+    if os.name == 'posix':
+        return lambda: os.times()[4]
+    return time.time
+
+
+clock = _get_clock()
+
+_caches = weakref.WeakSet()
+_caches_lock = threading.Lock()
+_purger = None
+_purger_pid = None
 
 
 class Cache:
     '''
     Utility to store data in memory for a short time and retrieve them quickly.
+    The cache is bounded: when it is full, the least recently used entry is
+    evicted. Expired entries are purged in background. Every operation is
+    protected by a lock so a cache can be shared by the threads of a
+    multithreaded mount.
     '''
 
-    def __init__(self, validity_period=VALIDITY_PERIOD):
+    def __init__(self, validity_period=VALIDITY_PERIOD, max_size=MAX_SIZE):
         '''
-        Initialize cache dict one for the data to store, the other one to store
-        validity time stamps.
+        Initialize cache dict, every entry stores data with its expiration
+        time. Entries are ordered from the least to the most recently used.
+        Validity period is a timedelta or a number of seconds. If max_size is
+        None the cache is not bounded.
         '''
-        self._cache = {}
-        self._timestamps = {}
+        self._cache = collections.OrderedDict()
+        self._lock = threading.RLock()
         self.validity_period = validity_period
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _register(self)
 
     def get(self, key):
         '''
         Return value corresponding to given key from cache if it is present
         and the validity period is not expired.
         '''
-        now = datetime.datetime.now()
-        if self._timestamps.get(key, now) > now:
-            return self._cache[key]
-        else:
-            self.remove(key)
-            return None
+        now = clock()
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            elif entry[1] <= now:
+                self.misses += 1
+                self.evictions += 1
+                return None
+            else:
+                self._cache[key] = entry
+                self.hits += 1
+                return entry[0]
 
     def add(self, key, value):
         '''
         Add a key/value couple to the cache that will be valing for defined
         validity period.
         '''
-        now = datetime.datetime.now()
-        self._cache[key] = value
-        self._timestamps[key] = now + self.validity_period
+        if _purger_pid != os.getpid():
+            _start_purger()
+        expiration = clock() + self._get_validity_seconds()
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (value, expiration)
+            self._evict(self.max_size)
 
     def remove(self, key):
         '''
         Remove couple key/value from cache.
         '''
-        if key in self._cache:
-            del self._cache[key]
-        if key in self._timestamps:
-            del self._timestamps[key]
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def resize(self, max_size):
+        '''
+        Change the maximum number of entries, evict entries if needed.
+        '''
+        with self._lock:
+            self.max_size = max_size
+            self._evict(max_size)
+
+    def purge(self):
+        '''
+        Remove all expired entries.
+        '''
+        now = clock()
+        with self._lock:
+            expired = [key for (key, entry) in self._cache.items()
+                       if entry[1] <= now]
+            for key in expired:
+                del self._cache[key]
+            self.evictions += len(expired)
+
+    def stats(self):
+        '''
+        Return cache size and hit, miss and eviction counters.
+        '''
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _get_validity_seconds(self):
+        if isinstance(self.validity_period, datetime.timedelta):
+            return self.validity_period.total_seconds()
+        else:
+            return self.validity_period
+
+    def _evict(self, max_size):
+        if max_size is None:
+            return
+        while len(self._cache) > max_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+
+def _register(cache):
+    '''
+    Register cache to the background purge.
+    '''
+    with _caches_lock:
+        _caches.add(cache)
+
+
+def _start_purger():
+    '''
+    Start the purge thread if it is not running in this process. It is
+    started when entries are first added rather than when caches are
+    created, because caches are created at import time and FUSE forks
+    afterwards: threads do not survive the fork.
+    '''
+    global _purger, _purger_pid
+    with _caches_lock:
+        if _purger_pid == os.getpid():
+            return
+        _purger = threading.Thread(target=_purge_caches)
+        _purger.daemon = True
+        _purger.start()
+        _purger_pid = os.getpid()
+
+
+def _purge_caches():
+    '''
+    Remove expired entries from every living cache periodically.
+    '''
+    while True:
+        time.sleep(PURGE_INTERVAL)
+        with _caches_lock:
+            caches = list(_caches)
+        for cache in caches:
+            cache.purge()
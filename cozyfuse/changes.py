@@ -0,0 +1,95 @@
+import threading
+import time
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+HEARTBEAT = 30000
+RETRY_DELAY = 5
+
+
+class ChangesListener:
+    '''
+    Listen to the continuous changes feed of a database and give every change
+    to the subscribed callbacks. When the connection is lost, it reconnects
+    and starts again from the last sequence number received, so no change is
+    missed.
+    '''
+
+    def __init__(self, db, since=0, include_docs=True, filter=None,
+                 heartbeat=HEARTBEAT):
+        '''
+        Configure the feed. *since* is the sequence number from which changes
+        are listened. *heartbeat* is the delay (ms) between two empty lines
+        sent by CouchDB to keep the connection alive.
+        '''
+        self.db = db
+        self.seq = since
+        self.include_docs = include_docs
+        self.filter = filter
+        self.heartbeat = heartbeat
+        self.callbacks = []
+        self.running = False
+
+    def subscribe(self, callback):
+        '''
+        Register a function that will be called with each change line.
+        '''
+        self.callbacks.append(callback)
+
+    def run(self):
+        '''
+        Read changes feed until the listener is stopped.
+        '''
+        self.running = True
+        while self.running:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception('[Changes] Changes feed interrupted')
+                time.sleep(RETRY_DELAY)
+
+    def start(self):
+        '''
+        Run the listener in a background thread.
+        '''
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        '''
+        Stop listening, it takes effect with the next change received.
+        '''
+        self.running = False
+
+    def _listen(self):
+        options = {
+            'feed': 'continuous',
+            'since': self.seq,
+            'heartbeat': self.heartbeat,
+            'include_docs': self.include_docs,
+        }
+        if self.filter is not None:
+            options['filter'] = self.filter
+
+        for line in self.db.changes(**options):
+            if not self.running:
+                return
+            if 'last_seq' in line:
+                self.seq = line['last_seq']
+            else:
+                # A change that a callback fails to handle is skipped, the
+                # feed would otherwise restart from it forever.
+                for callback in self.callbacks:
+                    try:
+                        callback(line)
+                    except Exception:
+                        logger.exception(
+                            '[Changes] Change %s could not be handled',
+                            line.get('id'))
+                self.seq = line['seq']
@@ -0,0 +1,126 @@
+import urlparse
+import threading
+import requests
+import logging
+
+import local_config
+
+from couchdb import Server, http
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+COUCHDB_URL = 'http://localhost:5984/'
+
+# Number of connections kept alive by host.
+POOL_SIZE = 10
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class Connections:
+    '''
+    Persistent HTTP connections of a device. They are shared by every
+    request made to the local CouchDB and to the remote Cozy, so the TCP
+    connection setup is paid once.
+    '''
+
+    def __init__(self, name=None, pool_size=POOL_SIZE):
+        '''
+        Create sessions for device *name* (None means connections that are
+        not related to a device, like administration ones).
+        '''
+        self.name = name
+        self.pool_size = 0
+        self.session = requests.Session()
+        self.couchdb_session = http.Session()
+        self._servers = {}
+        self._lock = threading.Lock()
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size):
+        '''
+        Set the number of connections kept alive by host for raw HTTP
+        requests.
+        '''
+        with self._lock:
+            self.pool_size = pool_size
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    def get_server(self, credentials=True):
+        '''
+        Return CouchDB server connector. If credentials is True, requests
+        are authenticated with the device database credentials.
+        '''
+        credentials = credentials and self.name is not None
+        with self._lock:
+            server = self._servers.get(credentials)
+            if server is None:
+                server = Server(COUCHDB_URL, session=self.couchdb_session)
+                if credentials:
+                    server.resource.credentials = \
+                        local_config.get_db_credentials(self.name)
+                self._servers[credentials] = server
+            return server
+
+    def get_db(self, credentials=True):
+        '''
+        Return device database connector.
+        '''
+        return self.get_server(credentials)[self.name]
+
+
+def get_connections(name=None, pool_size=None):
+    '''
+    Return connections of given device, create them on first call. If
+    pool_size is given, the pool is enlarged to at least that size.
+    '''
+    with _connections_lock:
+        connections = _connections.get(name)
+        if connections is None:
+            connections = Connections(name, max(pool_size or 0, POOL_SIZE))
+            _connections[name] = connections
+    if pool_size is not None and pool_size > connections.pool_size:
+        connections.set_pool_size(pool_size)
+    return connections
+
+
+def get_url(name=None, credentials=None):
+    '''
+    Return URL of the local CouchDB, or of the database of given device.
+    *credentials* is an optional (login, password) couple added to the URL.
+    '''
+    (scheme, netloc, path) = urlparse.urlsplit(COUCHDB_URL)[:3]
+    if credentials is not None:
+        netloc = '%s:%s@%s' % (credentials[0], credentials[1], netloc)
+    url = '%s://%s%s' % (scheme, netloc, path)
+    if name is not None:
+        url = '%s/%s' % (url.rstrip('/'), name)
+    return url
+
+
+def get_session(name=None):
+    '''
+    Return the shared requests session of given device.
+    '''
+    return get_connections(name).session
+
+
+def get_server(name=None, credentials=True):
+    '''
+    Return the shared CouchDB server connector of given device.
+    '''
+    return get_connections(name).get_server(credentials)
+
+
+def close(name=None):
+    '''
+    Close connections of given device, next calls will create new ones.
+    '''
+    with _connections_lock:
+        connections = _connections.pop(name, None)
+    if connections is not None:
+        connections.session.close()
@@ -19,29 +19,49 @@ import datetime
 import ntpath
 import mimetypes
 import re
+import threading
+import time
 
 import cache
 import fusepath
 import dbutils
 import binarycache
 import local_config
+import metadataindex
+import changes
+import writeback
+import groupcommit
+import debouncer
+import metrics
+import connection
 
-from couchdb import ResourceNotFound
 
 ATTR_VALIDITY_PERIOD = datetime.timedelta(seconds=10)
 
+# Once caches are invalidated by the changes feed, their entries can be kept
+# much longer.
+LISTENED_VALIDITY_PERIOD = datetime.timedelta(hours=1)
+INDEX_RETRY_DELAY = 10
+
+# Delay (s) between two dumps of the metrics file.
+METRICS_INTERVAL = 10
+
+# Maximum number of entries kept by each cache of the file system.
+ATTR_CACHE_SIZE = 20000
+NAME_CACHE_SIZE = 1000
+FILE_SIZE_CACHE_SIZE = 1000
+
 DEVNULL = open(os.devnull, 'wb')
 EXCLUDED_PATTERNS = ['^\.(.*)', '(.*)~$']
 
 fuse.fuse_python_api = (0, 2)
 
 CONFIG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
-HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
-HDLR.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 
+# Operations that run on the hot path log at DEBUG level, set COZYFUSE_LOG
+# to "couchmount=debug" to see them.
 logger = logging.getLogger(__name__)
-logger.addHandler(HDLR)
-logger.setLevel(logging.INFO)
+local_config.configure_logger(logger)
 
 
 
@@ -94,15 +114,44 @@ class CouchStat(fuse.Stat):
             self.st_mtime = self.st_atime
 
 
+class FileHandle(object):
+    '''
+    Handle returned by open. Every open call gets its own handle which keeps
+    the OS file descriptor of the cached binary until the file is released.
+    A partial handle reads a binary which is downloaded on demand. A dirty
+    handle modified the cached binary, which must be uploaded on release.
+    '''
+
+    def __init__(self, path, fd, flags):
+        self.path = path
+        self.fd = fd
+        self.flags = flags
+        self.partial = False
+        self.dirty = (flags & os.O_TRUNC) != 0
+
+    def close(self):
+        '''
+        Close underlying file descriptor.
+        '''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 class CouchFSDocument(fuse.Fuse):
     '''
     Fuse implementation behavior: handles synchronisation with device when a
     change occurs or when users want to access to his/her file system.
     '''
 
-    def __init__(self, device_name, mountpoint, uri=None, *args, **kwargs):
+    def __init__(self, device_name, mountpoint, uri=None, threads=1,
+                 folder_update_window=debouncer.WINDOW, *args, **kwargs):
         '''
         Configure file system, device and store remote Cozy informations.
+        *threads* is the number of binaries that can be downloaded at the same
+        time when the file system is served by several threads.
+        *folder_update_window* is the delay (s) during which last
+        modification updates of a folder are coalesced.
         '''
         logger.info('Configuring CouchDB Fuse...')
 
@@ -128,11 +177,8 @@ class CouchFSDocument(fuse.Fuse):
         # Configure replication urls.
         (self.db_username, self.db_password) = \
             local_config.get_db_credentials(device_name)
-        self.rep_source = 'http://%s:%s@localhost:5984/%s' % (
-            self.db_username,
-            self.db_password,
-            self.device
-        )
+        self.rep_source = connection.get_url(
+            self.device, (self.db_username, self.db_password))
         self.rep_target = "https://%s:%s@%s/cozy" % (
             self.loginCozy,
             self.passwordCozy,
@@ -143,14 +189,56 @@ class CouchFSDocument(fuse.Fuse):
         # Configure cache and create required folders
         device_path = os.path.join(CONFIG_FOLDER, device_name)
         self.binary_cache = binarycache.BinaryCache(
-            device_name, device_path, self.rep_source, mountpoint)
-        self.file_size_cache = cache.Cache()
-        self.attr_cache = cache.Cache()
-        self.name_cache = cache.Cache()
-        self.fd_cache = cache.Cache()
+            device_name, device_path, self.rep_source, mountpoint,
+            max_downloads=threads)
+        self.file_size_cache = cache.Cache(max_size=FILE_SIZE_CACHE_SIZE)
+        self.attr_cache = cache.Cache(max_size=ATTR_CACHE_SIZE)
+        self.name_cache = cache.Cache(max_size=NAME_CACHE_SIZE)
+        metrics.register_cache('attr', self.attr_cache)
+        metrics.register_cache('name', self.name_cache)
+        metrics.register_cache('file_size', self.file_size_cache)
+        self.metrics_path = os.path.join(device_path, 'metrics.prom')
+
+        # Local metadata index, it is synchronized in background once the
+        # file system is mounted (see fsinit). Then the changes listener keeps
+        # it and the caches up to date.
+        self.index = metadataindex.MetadataIndex(
+            os.path.join(device_path, 'metadata.db'))
+        self.changes_listener = None
+
+        # Written files are uploaded in background.
+        self.writeback = writeback.WritebackQueue(
+            self.db, self.binary_cache,
+            os.path.join(device_path, 'writeback.json'))
+
+        # Files created or deleted at the same time by several FUSE threads
+        # are saved together. A single-threaded mount never has concurrent
+        # operations, so there is no point waiting for them.
+        if threads > 1:
+            window = groupcommit.WINDOW
+        else:
+            window = 0
+        self.creations = groupcommit.GroupCommit(
+            self._commit_creations, window=window,
+            max_size=dbutils.BULK_SIZE)
+        self.deletions = groupcommit.GroupCommit(
+            self._commit_deletions, window=window,
+            max_size=dbutils.BULK_SIZE)
+
+        # Last modification dates of parent folders are saved in bulk once
+        # per window.
+        self.folder_updates = debouncer.Debouncer(
+            self._flush_folder_updates, window=folder_update_window)
+
+        # Handles of opened files, they are closed when released or when the
+        # file system is unmounted.
+        self.file_handles = set()
+        self.file_handles_lock = threading.Lock()
 
         logger.info('- Cache configured')
 
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def getattr(self, path):
         """
         Return file descriptor for given_path. FS requires constantly
@@ -160,7 +248,7 @@ class CouchFSDocument(fuse.Fuse):
         Useful for 'ls -la' command like.
         """
         try:
-            logger.info('getattr %s' % path)
+            logger.debug('getattr %s', path)
             path = fusepath.normalize_path(path)
 
             # Try to get attribute from local cache.
@@ -175,11 +263,16 @@ class CouchFSDocument(fuse.Fuse):
                     st = CouchStat()
                     st.set_root()
 
+                # Once synchronized, the local index knows every file and
+                # folder, no need to query the database.
+                elif self.index.is_ready():
+                    st = self._get_attr_from_index(path)
+
                 else:
                     # Avoid to check in database if non existing file/folder
                     # exists.
                     if not self._is_in_list_cache(path):
-                        logger.info('Not found (not in list cache): %s' % path)
+                        logger.debug('Not found (not in list cache): %s', path)
                         return -errno.ENOENT
                     else:
                         # Build attributes from database metadata.
@@ -187,7 +280,7 @@ class CouchFSDocument(fuse.Fuse):
 
                 # If no st was built, the file is considered as absent.
                 if st is None:
-                    logger.info('Not found (not in database): %s' % path)
+                    logger.debug('Not found (not in database): %s', path)
                     return -errno.ENOENT
                 else:
                     return st
@@ -196,6 +289,8 @@ class CouchFSDocument(fuse.Fuse):
             logger.exception(e)
             return -errno.ENOENT
 
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def mkdir(self, path, mode):
         """
         Create folder in current FS add a folder in the database and update
@@ -203,7 +298,7 @@ class CouchFSDocument(fuse.Fuse):
             path {string}: diretory path
             mode {string}: directory permissions
         """
-        logger.info('mkdir %s' % path)
+        logger.info('mkdir %s', path)
         try:
             path = fusepath.normalize_path(path)
             parent_path, name = fusepath.split(path)
@@ -213,12 +308,12 @@ class CouchFSDocument(fuse.Fuse):
 
             # Check folder existence.
             if folder is not None:
-                logger.info('folder already exists %s' % path)
+                logger.info('folder already exists %s', path)
                 return -errno.EEXIST
 
             # Create folder.
             else:
-                logger.info('folder creation... %s %s' % (parent_path, name))
+                logger.info('folder creation... %s %s', parent_path, name)
                 folder = dbutils.create_folder(self.db, {
                     "name": name,
                     "path": parent_path,
@@ -226,6 +321,7 @@ class CouchFSDocument(fuse.Fuse):
                     'creationDate': now,
                     'lastModification': now,
                 })
+                self.index.update_doc(folder)
 
                 self._update_parent_folder(parent_path)
                 self._add_to_cache(path)
@@ -236,84 +332,91 @@ class CouchFSDocument(fuse.Fuse):
             logger.exception(e)
             return -errno.EEXIST
 
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def mknod(self, path, mode, dev):
         """
         Create a new node on the CouchFS. It leads to prepare file creation by
         creating a binary document and a file document in the database.
-        Then it creates binary cache file (empty file).
+        Creations made at the same time are committed together.
 
         Parent folder last modification date is updated.
         """
         try:
-            logger.info('mknod %s, %s, %s' % (dev, mode, path))
+            logger.info('mknod %s, %s, %s', dev, mode, path)
             path = fusepath.normalize_path(path)
 
-            binary_id = self._create_empty_binary_in_db()
-            self._create_new_file_in_db(path, binary_id)
-            self._create_new_file(path)
-            self._update_parent_folder(path)
-            logger.info('mknod is done for %s' % path)
+            file_doc = self.creations.submit(self._get_new_file_doc(path))
+            self.index.update_doc(file_doc)
+            self._add_to_cache(path)
+            logger.debug('mknod is done for %s', path)
             return 0
 
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
 
-
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def open(self, path, flags):
         """
-        Open file, mainly check if the file exists or not.
+        Open file, mainly check if the file exists or not. It returns a new
+        file handle that fuse gives back to read, write and release.
             path {string}: file path
             flags {string}: opening mode
         """
         try:
-            logger.info('open %s, %s' % (flags, path))
+            logger.debug('open %s, %s', flags, path)
             path = fusepath.normalize_path(path)
 
             if self._is_found(path):
                 (file_doc, binary_id, filename) =  \
                     self.binary_cache.get_file_metadata(path)
 
-                if (flags & 3) == os.O_RDONLY or (flags & 3) == os.O_RDWR:
-                    if not self.binary_cache.is_cached(path):
-                        self.binary_cache.add(path)
-                    fd = os.open(filename, flags)
-                    self.fd_cache.add(path, fd)
-                    return 0
+                if (flags & 3) == os.O_RDONLY:
+                    self.binary_cache.prepare(path)
+                    fh = self._open_handle(path, filename, flags)
+                    fh.partial = not self.binary_cache.is_cached(path)
+                    return fh
+
+                elif (flags & 3) == os.O_RDWR:
+                    self.binary_cache.fetch(path)
+                    return self._open_handle(path, filename, flags)
 
                 elif (flags & 3) == os.O_WRONLY:
                     if not self.binary_cache.is_cached(path):
                         self.binary_cache.add(path, '')
-                    fd = os.open(filename, flags)
-                    self.fd_cache.add(path, fd)
-                    return 0
+                    return self._open_handle(path, filename, flags)
 
                 else:
-                    logger.info('open: unrecognized flags %s' % flags)
+                    logger.info('open: unrecognized flags %s', flags)
                     return -errno.EINVAL
             else:
-                logger.error('File not found %s' % path)
+                logger.error('File not found %s', path)
                 return -errno.ENOENT
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
 
-    def read(self, path, length, offset):
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
+    def read(self, path, length, offset, fh):
         """
-        Return content of binary cache of file located at given path.
-        It extracts binary from remote Cozy and save it in a cache folder if
-        it does not already exists.
+        Return content of binary cache of file located at given path. Data
+        are read from the handle file descriptor. If the binary is not fully
+        cached, missing blocks of the requested part are downloaded first.
             path {string}: file path
             size {integer}: size of file part to read
             offset {integer}=: beginning of file part to read
+            fh {FileHandle}: handle returned by open
         """
         try:
-            logger.info('read %s' % path)
-            path = fusepath.normalize_path(path)
-            fh = self.fd_cache.get(path)
-            logger.info(fh)
-            os.lseek(fh, offset, os.SEEK_SET)
-            return os.read(fh, length)
+            logger.debug('read %s', path)
+            if fh.partial:
+                fh.partial = not self.binary_cache.fetch_range(
+                    fh.path, offset, length)
+            os.lseek(fh.fd, offset, os.SEEK_SET)
+            return os.read(fh.fd, length)
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
@@ -324,51 +427,62 @@ class CouchFSDocument(fuse.Fuse):
         it arrives.
         Perform doc and attr caching for each returned results.
         """
-        logger.info('readdir %d %s' % (offset, path))
+        logger.debug('readdir %d %s', offset, path)
         path = fusepath.normalize_path(path)
 
+        start = metrics.clock()
         names = ['.', '..'] + self._get_names(path)
+        metrics.observe('cozyfuse_operation_seconds', metrics.clock() - start,
+                        op='readdir')
         for name in names:
             yield fuse.Direntry(name.encode('utf-_8'))
 
-    def release(self, path, flags):
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
+    def release(self, path, flags, fh):
         """
         It's the method called after writing operations are ended.
-        Ii saves file size metadata to database.
+        It closes the file handle. If the file was modified, local metadata
+        are updated with the new size and the binary upload is queued, the
+        database is updated once the upload is done.
         """
         try:
-            logger.info('release %s' % path)
+            logger.debug('release %s', path)
             path = fusepath.normalize_path(path)
 
-            fd = self.fd_cache.get(path)
-            os.close(fd)
-            if (flags & 3) == os.O_WRONLY:
-                try:
-                    size = self.binary_cache.update_size(path)
-                    logger.info('step 1')
-                    self.file_size_cache.add(path, size)
-                    logger.info('step 2')
-                    self._get_attr_from_db(path, isfile=True)
-                    logger.info('step 3')
-                    self._add_to_cache(path)
-                    logger.info('file released')
-                except ResourceNotFound:
+            if fh.dirty:
+                size = os.fstat(fh.fd).st_size
+            self._close_handle(fh)
+
+            if fh.dirty:
+                file_doc = dbutils.get_file(self.db, path)
+                if file_doc is None:
                     logger.info('release error file not found')
                     self._clean_cache(path)
-                return 0
-            else:
-                logger.info('No file descriptor')
-                return -errno.ENOENT
+                else:
+                    file_doc['size'] = size
+                    self.index.update_doc(file_doc)
+                    self.file_size_cache.add(path, size)
+                    st = CouchStat()
+                    st.set_file(file_doc)
+                    self.attr_cache.add(path, st)
+                    self._add_to_cache(path)
+                    self.writeback.enqueue(file_doc)
+                    logger.debug('file released')
+            return 0
 
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
 
-    def rename(self, pathfrom, pathto, root=True):
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
+    def rename(self, pathfrom, pathto):
         """
-        Rename file and subfiles (if it's a folder) in device.
+        Rename file or folder in device. When a folder is renamed, all its
+        descendants are moved too with bulk requests.
         """
-        logger.info("rename %s -> %s: " % (pathfrom, pathto))
+        logger.info("rename %s -> %s: ", pathfrom, pathto)
         try:
             pathfrom = fusepath.normalize_path(pathfrom)
             pathto = fusepath.normalize_path(pathto)
@@ -382,7 +496,8 @@ class CouchFSDocument(fuse.Fuse):
                     "path": file_path,
                     "lastModification": fusepath.get_current_date()
                 })
-                dbutils.update_file(self.db, file_doc)
+                dbutils.update_file(self.db, file_doc, oldpath=pathfrom)
+                self.index.update_doc(file_doc)
 
             folder_doc = dbutils.get_folder(self.db, pathfrom)
             if folder_doc is not None:
@@ -393,43 +508,24 @@ class CouchFSDocument(fuse.Fuse):
                     "lastModification": fusepath.get_current_date()
                 })
 
-                # Rename all subfiles
-                for res in self.db.view("file/byFolder", key=pathfrom):
-                    child_pathfrom = os.path.join(
-                        res.value['path'],
-                        res.value['name']
-                    )
-                    child_pathto = os.path.join(folder_path, name, res.value['name'])
-                    self.rename(child_pathfrom, child_pathto, False)
-
-                for res in self.db.view("folder/byFolder", key=pathfrom):
-                    child_pathfrom = os.path.join(
-                        res.value['path'],
-                        res.value['name'])
-                    child_pathto = os.path.join(folder_path, name, res.value['name'])
-                    self.rename(child_pathfrom, child_pathto, False)
-
-                dbutils.update_folder(self.db, folder_doc)
-
-            parent_path_from, namefrom = fusepath.split(pathfrom)
-            parent_path_to, nameto = fusepath.split(pathto)
-
-            if root:
-                self._update_parent_folder(parent_path_from)
-                self._update_parent_folder(parent_path_to)
+                # Move all files and folders located under renamed folder.
+                try:
+                    moved = dbutils.move_subtree(self.db, pathfrom, pathto)
+                except dbutils.BulkUpdateError as e:
+                    # Part of the subtree is moved, index and caches must
+                    # follow before the error is reported.
+                    self._on_subtree_moved(e.moved)
+                    raise
+                self._on_subtree_moved(moved)
 
-            names = dbutils.name_cache.get(parent_path_from)
-            if names is not None and namefrom in names:
-                names.remove(namefrom)
-                names.add(parent_path_from, names)
+                dbutils.update_folder(self.db, folder_doc, oldpath=pathfrom)
+                self.index.update_doc(folder_doc)
 
-            names = dbutils.name_cache.get(parent_path_to)
-            if names is not None:
-                names.append(nameto)
-                names.add(parent_path_to, names)
+            self._update_parent_folder(fusepath.split(pathfrom)[0])
+            self._update_parent_folder(fusepath.split(pathto)[0])
 
-            self._clean_cache(pathfrom)
-            self._add_to_cache(pathto)
+            self._invalidate(pathfrom)
+            self._invalidate(pathto)
 
             if folder_doc is None and file_doc is None:
                 return -errno.ENOENT
@@ -440,16 +536,22 @@ class CouchFSDocument(fuse.Fuse):
             logger.exception(e)
             return -errno.ENOENT
 
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def rmdir(self, path):
         """
         Delete folder from database and clean caches accordingly.
             path {string}: folder path
         """
-        logger.info('rmdir %s' % path)
+        logger.info('rmdir %s', path)
         try:
             path = fusepath.normalize_path(path)
             folder = dbutils.get_folder(self.db, path)
-            dbutils.delete_folder(self.db, folder)
+            if folder is None:
+                logger.error('Folder not found %s', path)
+                return -errno.ENOENT
+            self.deletions.submit(folder)
+            self.index.remove(folder['_id'])
             self._clean_cache(path)
             return 0
 
@@ -457,19 +559,22 @@ class CouchFSDocument(fuse.Fuse):
             logger.exception(e)
             return -errno.ENOENT
 
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def unlink(self, path):
         """
         Remove file from current FS. Update cache accordingly.
         """
         try:
-            logger.info('unlink %s' % path)
+            logger.info('unlink %s', path)
             path = fusepath.normalize_path(path)
 
-            if dbutils.get_file(self.db, path) is not None:
-                self.binary_cache.remove(path)
+            file_doc = dbutils.get_file(self.db, path)
+            if file_doc is not None:
+                self.deletions.submit(file_doc)
+                self.index.remove(file_doc['_id'])
+                self.binary_cache.discard(path, file_doc)
                 self._clean_cache(path, True)
-                self._remove_file_from_db(path)
-                self._update_parent_folder(path)
                 return 0
             else:
                 logger.info('Cannot delete file, no entry found')
@@ -479,65 +584,74 @@ class CouchFSDocument(fuse.Fuse):
             logger.exception(e)
             return -errno.ENOENT
 
-    def write(self, path, buf, offset):
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
+    def write(self, path, buf, offset, fh):
         """
         Write data in binary cache of file located at given path.
             path {string}: file path
             buf {buffer}: data to write
+            fh {FileHandle}: handle returned by open
         """
-        logger.info('write %s: %s' % (offset, path))
+        logger.debug('write %s: %s', offset, path)
         path = fusepath.normalize_path(path)
-        fh = self.fd_cache.get(path)
-        os.lseek(fh, offset, os.SEEK_SET)
-        val = os.write(fh, buf)
-        logger.info(val)
+        os.lseek(fh.fd, offset, os.SEEK_SET)
+        val = os.write(fh.fd, buf)
+        fh.dirty = True
         attr = self.attr_cache.get(path)
-        logger.info(attr)
-        attr.st_size = self.binary_cache.get_current_size(path)
-        logger.info(attr)
-        self.attr_cache.add(path, attr)
+        if attr is not None:
+            attr.st_size = os.fstat(fh.fd).st_size
+            self.attr_cache.add(path, attr)
         return val
 
-    def fsync(self, path, isfsyncfile):
-        logger.info('fsync %s, %s' % (path, isfsyncfile))
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
+    def fsync(self, path, isfsyncfile, fh=None):
+        logger.debug('fsync %s, %s', path, isfsyncfile)
         return 0
 
+    @metrics.timed('cozyfuse_operation')
     def access(self, path, mode):
-        logger.info('access %s, %s' % (path, mode))
+        logger.debug('access %s, %s', path, mode)
         #return 0
 
+    @metrics.timed('cozyfuse_operation')
     def chmod(self, path, mode):
-        logger.info('chmod %s, %s' % (path, mode))
+        logger.debug('chmod %s, %s', path, mode)
         return 0
 
+    @metrics.timed('cozyfuse_operation')
     def chown(self, path, uid, gid):
-        logger.info('chown %s, %s, %s' % (path, uid, gid))
+        logger.debug('chown %s, %s, %s', path, uid, gid)
         return 0
 
     #def symlink(self, target, name):
-        #logger.info('symlink %s, %s' % (target, name))
+        #logger.info('symlink %s, %s', target, name)
         #return 0
 
     #def link(self, target, name):
-        #logger.info('link %s, %s' % (target, name))
+        #logger.info('link %s, %s', target, name)
         #return 0
 
     #def utime(self, path, times):
-        #logger.info('utime %s, %s' % (path, times))
+        #logger.info('utime %s, %s', path, times)
         #return 0
 
     #def utimens(self, path, times=None):
-        #logger.info('utimens %s, %s' % (path, times))
+        #logger.info('utimens %s, %s', path, times)
         #return 0
 
+    @local_config.traced(logger)
+    @metrics.timed('cozyfuse_operation')
     def truncate(self, path, length, fh=None):
-        logger.info('truncate %s, %s' % (path, length))
+        logger.debug('truncate %s, %s', path, length)
         return 0
 
     #def flush(self, path, fh):
-        #logger.info('flush %s, %s' % (path, fh))
+        #logger.info('flush %s, %s', path, fh)
         #return 0
 
+    @metrics.timed('cozyfuse_operation')
     def statfs(self):
         """
         It is the file system global attributes.
@@ -578,73 +692,193 @@ class CouchFSDocument(fuse.Fuse):
 
         return st
 
-    def _is_found(self, path):
+    def fsinit(self):
         '''
-        Returns true if the path exists in the database, false either.
+        Start metadata index synchronization, changes listening, metrics
+        dumps and pending uploads once the file system is mounted.
         '''
-        path = fusepath.normalize_path(path)
-        file_doc = dbutils.get_file(self.db, path)
-        return file_doc is not None
+        thread = threading.Thread(target=self._follow_changes)
+        thread.daemon = True
+        thread.start()
+        thread = threading.Thread(target=self._dump_metrics)
+        thread.daemon = True
+        thread.start()
+        self.writeback.start()
+
+    def fsdestroy(self):
+        '''
+        Stop listening to changes, close file handles that were not
+        released before unmounting, save pending folder updates, finish
+        cache folder removals and write metrics a last time.
+        '''
+        if self.changes_listener is not None:
+            self.changes_listener.stop()
+        with self.file_handles_lock:
+            handles = list(self.file_handles)
+            self.file_handles.clear()
+        for fh in handles:
+            fh.close()
+        self.folder_updates.flush()
+        self.binary_cache.join()
+        metrics.dump(self.metrics_path)
+
+    def _dump_metrics(self):
+        '''
+        Write metrics to the device folder periodically, they are displayed
+        by the stats command.
+        '''
+        while True:
+            try:
+                metrics.dump(self.metrics_path)
+            except Exception:
+                logger.exception('Metrics dump failed')
+            time.sleep(METRICS_INTERVAL)
 
-    def _create_new_file(self, path):
+    def _follow_changes(self):
         '''
-        Create empty binary cache and load file metadata from database.
+        Synchronize metadata index then listen to the database changes feed
+        to keep index and caches up to date. As every change invalidates
+        the related cache entries, cache validity periods are extended.
         '''
-        file_doc = dbutils.get_file(self.db, path)
-        file_doc['size'] = 0
-        file_doc['lastModification'] = fusepath.get_current_date()
-        dbutils.update_file(self.db, file_doc)
+        while True:
+            try:
+                self.index.sync(self.db)
+                break
+            except Exception:
+                logger.exception('Metadata index synchronization failed')
+                time.sleep(INDEX_RETRY_DELAY)
+        logger.info('Metadata index synchronized')
+
+        self.changes_listener = changes.ChangesListener(
+            self.db, since=self.index.seq)
+        self.changes_listener.subscribe(self._on_change)
+
+        for listened_cache in [
+            self.attr_cache,
+            self.name_cache,
+            self.file_size_cache,
+            self.binary_cache.metadata_cache,
+            dbutils.file_cache,
+            dbutils.folder_cache,
+            dbutils.name_cache,
+        ]:
+            listened_cache.validity_period = LISTENED_VALIDITY_PERIOD
+
+        self.changes_listener.run()
+
+    def _on_change(self, line):
+        '''
+        Apply change to the metadata index and invalidate cache entries of
+        the changed document, at its previous and at its current path.
+        '''
+        paths = [self.index.get_path(line['id'])]
+        self.index.apply_changes([line], line['seq'])
+
+        doc = line.get('doc')
+        if not line.get('deleted', False) and doc is not None \
+           and doc.get('docType') in metadataindex.DOC_TYPES:
+            paths.append(fusepath.join(doc['path'], doc['name']))
+
+        for path in paths:
+            if path is not None:
+                self._invalidate(path)
 
-    def _create_empty_binary_in_db(self):
+    def _invalidate(self, path):
         '''
-        Create an empty binary object in database and returns its id.
+        Remove every cache entry related to given path, including the name
+        list of its parent folder.
         '''
-        new_binary = {"docType": "Binary"}
-        binary_id = self.db.create(new_binary)
-        self.db.put_attachment(self.db[binary_id], '', filename="file")
-        return binary_id
+        dirname, name = fusepath.split(path)
+        self.attr_cache.remove(path)
+        self.file_size_cache.remove(path)
+        self.binary_cache.metadata_cache.remove(path)
+        self.name_cache.remove(dirname)
+        dbutils.file_cache.remove(path)
+        dbutils.folder_cache.remove(path)
+        dbutils.name_cache.remove(dirname)
+
+    def _open_handle(self, path, filename, flags):
+        '''
+        Open cached binary and register a new handle for it.
+        '''
+        fh = FileHandle(path, os.open(filename, flags), flags)
+        with self.file_handles_lock:
+            self.file_handles.add(fh)
+        return fh
 
-    def _create_new_file_in_db(self, path, binary_id):
+    def _close_handle(self, fh):
         '''
-        Create new file document (metadata) in database. Set link with given
-        binary id. Then update caches accordingly.
+        Close given handle and unregister it.
+        '''
+        with self.file_handles_lock:
+            self.file_handles.discard(fh)
+        fh.close()
+
+    def _is_found(self, path):
+        '''
+        Returns true if the path exists in the database, false either.
+        '''
+        path = fusepath.normalize_path(path)
+        file_doc = dbutils.get_file(self.db, path)
+        return file_doc is not None
+
+    def _get_new_file_doc(self, path):
+        '''
+        Return metadata of a new empty file located at given path. Its binary
+        is set when the file is created.
         '''
         file_path, name = ntpath.split(path)
-        file_path = fusepath.normalize_path(file_path)
         (mime_type, encoding) = mimetypes.guess_type(path)
-        rev = self.db[binary_id]["_rev"]
         now = fusepath.get_current_date()
-        newFile = {
+        return {
             "name": name.decode('utf8'),
             "path": fusepath.normalize_path(file_path).decode('utf8'),
-            "binary": {
-                "file": {
-                    "id": binary_id,
-                    "rev": rev
-                }
-            },
             "docType": "File",
             "mime": mime_type,
+            "size": 0,
             'creationDate': now,
             'lastModification': now,
         }
-        dbutils.create_file(self.db, newFile)
-        names = self.name_cache.get(file_path)
-        if names is not None:
-            names.append(name)
 
-    def _remove_file_from_db(self, path):
+    def _commit_creations(self, file_docs):
         '''
-        Remove binary document if it exists, then remove file document.
+        Create a batch of files in database, then update their parent folders
+        once per batch.
         '''
-        file_doc = dbutils.get_file(self.db, path)
-        if file_doc["binary"] is not None and 'file' in file_doc["binary"]:
-            binary_id = file_doc["binary"]["file"]["id"]
-            try:
-                self.db.delete(self.db[binary_id])
-            except ResourceNotFound:
-                pass
-        dbutils.delete_file(self.db, file_doc)
+        results = dbutils.create_files(self.db, file_docs)
+        self._update_parent_folders([
+            file_doc for (file_doc, result) in zip(file_docs, results)
+            if result is file_doc])
+        return results
+
+    def _commit_deletions(self, docs):
+        '''
+        Delete a batch of files and folders from database, then update their
+        parent folders once per batch. Only the requests of documents that
+        could not be deleted fail.
+        '''
+        try:
+            dbutils.delete_docs(self.db, docs)
+            errors = {}
+        except dbutils.BulkUpdateError as e:
+            errors = dict(e.errors)
+        results = [errors.pop(doc['_id'], None) for doc in docs]
+        for (doc_id, error) in errors.items():
+            # Remaining errors concern Binary documents, their files are
+            # deleted anyway.
+            logger.error('Cannot delete binary %s: %s' % (doc_id, error))
+        self._update_parent_folders([
+            doc for (doc, result) in zip(docs, results) if result is None])
+        return results
+
+    def _update_parent_folders(self, docs):
+        '''
+        Update once every parent folder of given documents.
+        '''
+        parent_paths = set(
+            fusepath.normalize_path(doc['path']) for doc in docs)
+        for parent_path in parent_paths:
+            self._update_parent_folder(parent_path)
 
     def _update_parent_folder(self, parent_folder):
         """
@@ -652,13 +886,30 @@ class CouchFSDocument(fuse.Fuse):
             parent_folder {string}: parent folder path
 
         When a file or a folder is renamed/created/removed, last modification
-        date of parent folder should be updated
+        date of parent folder should be updated. Updates of the same folder
+        are coalesced and saved later (see _flush_folder_updates).
 
         """
-        folder = dbutils.get_folder(self.db, parent_folder)
-        if folder is not None:
-            folder['lastModification'] = fusepath.get_current_date()
-            dbutils.update_folder(self.db, folder)
+        self.folder_updates.add(
+            fusepath.normalize_path(parent_folder),
+            fusepath.get_current_date())
+
+    def _flush_folder_updates(self, dates):
+        '''
+        Save pending last modification dates of folders with bulk requests.
+        '''
+        try:
+            dbutils.touch_folders(self.db, dates)
+        except Exception as e:
+            logger.exception(e)
+
+    def _on_subtree_moved(self, moved):
+        '''
+        Update index and caches with documents moved by move_subtree.
+        '''
+        for (child_pathfrom, doc) in moved:
+            self.index.update_doc(doc)
+            self._invalidate(child_pathfrom)
 
     def _add_to_cache(self, path, isfile=False):
         dirname, name = fusepath.split(path)
@@ -670,7 +921,7 @@ class CouchFSDocument(fuse.Fuse):
         '''
         Remove ref of given path from all caches.
         '''
-        #logger.info('clean cache: %s' % path)
+        #logger.info('clean cache: %s', path)
         self.attr_cache.remove(path)
 
         dirname, name = ntpath.split(path)
@@ -680,7 +931,6 @@ class CouchFSDocument(fuse.Fuse):
             names.remove(name)
 
         if isfile:
-            self.binary_cache.remove(path)
             self.file_size_cache.remove(path)
             dbutils.file_cache.remove(path)
         else:
@@ -695,27 +945,22 @@ class CouchFSDocument(fuse.Fuse):
         Dirtly written to avoid running through folders and files too much
         time.
         '''
+        if self.index.is_ready():
+            return [entry['name'] for entry in self.index.list(path)]
+
         names = self.name_cache.get(path)
         if names is None:
             names = []
 
-            res = self.db.view('file/byFolder', key=path)
-            for doc in res:
-                name = doc.value["name"]
+            for entry in dbutils.get_folder_content(self.db, path):
+                name = entry["name"]
                 names.append(name)
-                filepath = os.path.join(path.encode('utf-8'), name.encode('utf-8'))
-                filepath = fusepath.normalize_path(filepath)
-                dbutils.file_cache.add(filepath, doc.value)
-                self._get_attr_from_db(filepath, isfile=True)
-
-            res = self.db.view('folder/byFolder', key=path)
-            for doc in res:
-                name = doc.value["name"]
-                names.append(name)
-                folderpath = os.path.join(path.encode('utf-8'), name.encode('utf-8'))
-                folderpath = fusepath.normalize_path(folderpath)
-                dbutils.folder_cache.add(folderpath, doc.value)
-                self._get_attr_from_db(folderpath, isfile=False)
+                st = CouchStat()
+                if entry["docType"] == "Folder":
+                    st.set_folder(entry)
+                else:
+                    st.set_file(entry)
+                self.attr_cache.add(fusepath.join(path, name), st)
 
             names.sort()
             self.name_cache.add(path, names)
@@ -731,11 +976,28 @@ class CouchFSDocument(fuse.Fuse):
         dirname = fusepath.normalize_path(dirname)
         names = self._get_names(dirname)
         if not filename.decode('utf-8') in names:
-            logger.info('File does not exist in cache: %s' % path)
+            logger.debug('File does not exist in cache: %s', path)
             return False
         else:
             return True
 
+    def _get_attr_from_index(self, path):
+        '''
+        Build fuse file attribute from data located in the local metadata
+        index.
+        '''
+        entry = self.index.get(path)
+        if entry is None:
+            return None
+
+        st = CouchStat()
+        if entry['docType'] == 'Folder':
+            st.set_folder(entry)
+        else:
+            st.set_file(entry)
+        self.attr_cache.add(path, st)
+        return st
+
     def _get_attr_from_db(self, path, isfile=None):
         '''
         Build fuse file attribute from data located in database. Check if path
@@ -787,16 +1049,22 @@ def unmount(path):
 
     # Do not display fail messages at unmounting
     subprocess.call(command, stdout=DEVNULL, stderr=subprocess.STDOUT)
-    logger.info('Folder %s unmounted' % path)
+    logger.info('Folder %s unmounted', path)
 
 
-def mount(name, path):
+def mount(name, path, threads=1, folder_update_window=debouncer.WINDOW):
     '''
-    Mount given folder corresponding to given device.
+    Mount given folder corresponding to given device. If *threads* is greater
+    than 1, FUSE requests are served by several threads, so a slow download
+    does not block the other operations on the mount. Last modification
+    updates of a folder are saved at most once per *folder_update_window*
+    seconds.
     '''
-    logger.info('Attempt to mount %s' % path)
-    fs = CouchFSDocument(name, path, uri='http://localhost:5984/%s' % name)
-    fs.multithreaded = 0
-    logger.info('CouchDB Fuse configured for %s' % path)
+    logger.info('Attempt to mount %s', path)
+    fs = CouchFSDocument(name, path, uri=connection.get_url(name),
+                         threads=threads,
+                         folder_update_window=folder_update_window)
+    fs.multithreaded = threads > 1
+    logger.info('CouchDB Fuse configured for %s', path)
     fs.main()
     return fs
@@ -1,34 +1,69 @@
 import json
+import uuid
 import string
 import random
-import requests
 import logging
 import datetime
 
 import local_config
 import cache
 import fusepath
+import connection
+import metrics
 
 
-from couchdb import Server, http
-from couchdb.http import PreconditionFailed, ResourceConflict
+from couchdb import http
+from couchdb.http import PreconditionFailed, ResourceConflict, \
+    ResourceNotFound
 
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
-file_cache = cache.Cache()
-folder_cache = cache.Cache()
-name_cache = cache.Cache()
+# Maximum number of entries kept by each metadata cache.
+FILE_CACHE_SIZE = 20000
+FOLDER_CACHE_SIZE = 5000
+NAME_CACHE_SIZE = 1000
+
+file_cache = cache.Cache(max_size=FILE_CACHE_SIZE)
+folder_cache = cache.Cache(max_size=FOLDER_CACHE_SIZE)
+name_cache = cache.Cache(max_size=NAME_CACHE_SIZE)
+metrics.register_cache('file', file_cache)
+metrics.register_cache('folder', folder_cache)
 
 
 ATTR_VALIDITY_PERIOD = datetime.timedelta(seconds=10)
 
+# Fields of file and folder documents returned by the tree view.
+TREE_FIELDS = ["name", "docType", "size", "lastModification"]
+
+# Names of databases where the tree view is missing and cannot be created.
+_missing_tree_views = set()
+
+# Number of documents sent by _bulk_docs request, and number of times a
+# document in conflict is fetched again and retried.
+BULK_SIZE = 500
+BULK_RETRIES = 3
+
+
+class BulkUpdateError(Exception):
+    '''
+    Some documents of a bulk update could not be saved. *errors* lists
+    (document id, exception) couples, *saved_docs* the documents saved
+    anyway.
+    '''
+
+    def __init__(self, errors, saved_docs):
+        Exception.__init__(self, 'Documents not saved: %s' % ', '.join(
+            '%s (%s)' % (doc_id, error) for (doc_id, error) in errors))
+        self.errors = errors
+        self.saved_docs = saved_docs
+
 
 def create_db(name):
     '''
     Create a new name for given name.
     '''
-    server = Server('http://localhost:5984/')
+    server = connection.get_server()
     try:
         db = server.create(name)
         logger.info('[DB] Database %s created' % name)
@@ -44,11 +79,7 @@ def get_db(name, credentials=True):
     Get or create given name from/in CouchDB.
     '''
     try:
-        server = Server('http://localhost:5984/')
-        if credentials:
-            server.resource.credentials = \
-                local_config.get_db_credentials(name)
-        return server[name]
+        return connection.get_connections(name).get_db(credentials)
     except Exception:
         logging.exception('[DB] Cannot connect to the database')
 
@@ -60,8 +91,7 @@ def get_db_and_server(database):
     Get or create given database from/in CouchDB.
     '''
     try:
-        server = Server('http://localhost:5984/')
-        server.resource.credentials = local_config.get_db_credentials(database)
+        server = connection.get_server(database)
         db = server[database]
         return (db, server)
     except Exception:
@@ -85,7 +115,8 @@ def remove_db(database):
     '''
     Destroy given database.
     '''
-    server = Server('http://localhost:5984/')
+    server = connection.get_server()
+    connection.close(database)
     try:
         server.delete(database)
     except http.ResourceNotFound:
@@ -118,18 +149,19 @@ def get_files(db):
     return db.view("file/all")
 
 
+@metrics.timed('cozyfuse_db', 'call')
 def create_folder(db, folder):
     '''
     Create a new folder and store it in the folder cache (path is the key).
     '''
-    folderid = db.create(folder)
-    folder = db[folderid]
+    db.save(folder)
 
     dirname, filename = (folder["path"], folder["name"])
     folder_cache.add(fusepath.join(dirname, filename), folder)
     return folder
 
 
+@metrics.timed('cozyfuse_db', 'call')
 def get_folder(db, path):
     '''
     Return folder of which path is equal to path. Try to get it from cache
@@ -146,47 +178,143 @@ def get_folder(db, path):
     return folder
 
 
-def update_folder(db, folder):
+@metrics.timed('cozyfuse_db', 'call')
+def update_folder(db, folder, oldpath=None):
     '''
-    Update given folder data. Retrieve last folder revision before doing it to
-    avoid conflicts.
-    Update folder cache too.
+    Save given folder with its known revision, the latest revision is fetched
+    only if the save conflicts. Update folder cache too. Give oldpath when the
+    folder was moved so its previous cache entry is dropped.
     '''
-    current_folder = db[folder["_id"]]
-    folder["_rev"] = current_folder["_rev"]
-    db.save(folder)
+    save_doc(db, folder)
 
     dirname, filename = (folder["path"], folder["name"])
     newpath = fusepath.join(dirname, filename)
+    if oldpath is not None and oldpath != newpath:
+        folder_cache.remove(oldpath)
+    folder_cache.add(newpath, folder)
 
-    dirname, filename = (current_folder["path"], current_folder["name"])
-    oldpath = fusepath.join(dirname, filename)
 
-    folder_cache.remove(oldpath)
-    folder_cache.add(newpath, folder)
+@metrics.timed('cozyfuse_db', 'call')
+def touch_folders(db, dates):
+    '''
+    Set last modification date of several folders with bulk requests.
+    *dates* maps folder paths to their new date. Folder cache is updated.
+    '''
+    folders = []
+    for path in dates:
+        folder = get_folder(db, path)
+        if folder is not None:
+            folders.append(folder)
 
+    def touch(folder):
+        path = fusepath.join(folder["path"], folder["name"])
+        folder["lastModification"] = dates[path]
 
+    for folder in bulk_update(db, folders, touch):
+        folder_cache.add(fusepath.join(folder["path"], folder["name"]), folder)
+
+
+@metrics.timed('cozyfuse_db', 'call')
 def delete_folder(db, folder):
     '''
     Delete given folder and remove it from cache.
     '''
-    db.delete(db[folder["_id"]])
+    delete_doc(db, folder["_id"], folder.get("_rev"))
 
     dirname, filename = (folder["path"], folder["name"])
     folder_cache.remove(fusepath.join(dirname, filename))
 
 
+@metrics.timed('cozyfuse_db', 'call')
 def create_file(db, file_doc):
     '''
     Create given file and add it to the file cache (key is the file path).
+    Return created document.
     '''
-    fileid = db.create(file_doc)
-    file_doc = db[fileid]
+    db.save(file_doc)
 
     dirname, filename = (fusepath.normalize_path(file_doc["path"]), file_doc["name"])
     file_cache.add(fusepath.join(dirname, filename), file_doc)
+    return file_doc
 
 
+@metrics.timed('cozyfuse_db', 'call')
+def create_files(db, file_docs):
+    '''
+    Create given file documents with an empty Binary document each. Ids are
+    generated locally so all binaries are created with a single _bulk_docs
+    request, then all files with a second one. Binaries of files that could
+    not be saved are deleted. Created files are added to the file cache.
+    Return, for each file, the created document or the exception raised by
+    its creation.
+    '''
+    binaries = []
+    for file_doc in file_docs:
+        file_doc.setdefault("_id", uuid.uuid4().hex)
+        binaries.append({
+            "_id": uuid.uuid4().hex,
+            "docType": "Binary",
+            "_attachments": {
+                "file": {
+                    "content_type": file_doc.get("mime") or
+                    "application/octet-stream",
+                    "data": "",
+                }
+            }
+        })
+
+    results = list(file_docs)
+    created = []
+    for (index, (success, binary_id, result)) in \
+            enumerate(db.update(binaries)):
+        if success:
+            file_docs[index]["binary"] = {
+                "file": {"id": binary_id, "rev": result}
+            }
+            created.append(index)
+        else:
+            results[index] = result
+
+    try:
+        saved = db.update([file_docs[index] for index in created])
+    except Exception:
+        _delete_binaries(db, [file_docs[index] for index in created])
+        raise
+
+    failed = []
+    for (index, (success, doc_id, result)) in zip(created, saved):
+        if success:
+            file_doc = file_docs[index]
+            dirname = fusepath.normalize_path(file_doc["path"])
+            file_cache.add(fusepath.join(dirname, file_doc["name"]), file_doc)
+        else:
+            results[index] = result
+            failed.append(file_docs[index])
+    if len(failed) > 0:
+        _delete_binaries(db, failed)
+    return results
+
+
+def _delete_binaries(db, file_docs):
+    '''
+    Delete Binary documents created for given files which could not be
+    saved, so they are not left orphaned.
+    '''
+    tombstones = []
+    for file_doc in file_docs:
+        binary = file_doc.pop("binary")["file"]
+        tombstones.append(
+            {"_id": binary["id"], "_rev": binary["rev"], "_deleted": True})
+    try:
+        for (success, doc_id, result) in db.update(tombstones):
+            if not success:
+                logger.error('[DB] Binary %s could not be deleted: %s',
+                             doc_id, result)
+    except Exception:
+        logger.exception('[DB] Binaries of unsaved files not deleted')
+
+
+@metrics.timed('cozyfuse_db', 'call')
 def get_file(db, path):
     '''
     Get file located at given path on the Couch FS. Add it to the cache.
@@ -203,35 +331,308 @@ def get_file(db, path):
     return file_doc
 
 
-def update_file(db, file_doc):
+@metrics.timed('cozyfuse_db', 'call')
+def get_folder_content(db, path):
     '''
-    Ensure file is latest revision then save it to database and update file
-    cache accordingly.
+    Return files and folders located in folder of given path. Each child is
+    described by a dict that contains only the fields required to build its
+    attributes: name, docType, size and lastModification.
+    If the tree view cannot be created, the file and folder views are
+    queried instead.
     '''
-    current_file_doc = db[file_doc["_id"]]
-    file_doc["_rev"] = current_file_doc["_rev"]
-    db.save(file_doc)
+    path = fusepath.normalize_path(path)
+    rows = _query_tree_view(db, "byParent", key=path)
+    if rows is not None:
+        return [res.value for res in rows]
 
-    dirname, filename = (file_doc["path"], file_doc["name"])
-    newpath = fusepath.join(dirname, filename)
+    content = []
+    for docType in ["file", "folder"]:
+        for res in db.view("%s/byFolder" % docType, key=path):
+            content.append(dict(
+                (key, value) for (key, value) in res.value.items()
+                if key in TREE_FIELDS))
+    return content
+
+
+@metrics.timed('cozyfuse_db', 'call')
+def get_subtree(db, path, include_docs=False):
+    '''
+    Return files and folders located under folder of given path, at any
+    depth, with a single range query on the tree view (its keys are path
+    components, so a subtree is a contiguous key range). Each element is a
+    dict with the tree fields plus path and binary id, or the full document
+    if include_docs is True.
+    If the tree view cannot be created, the tree is walked folder by folder.
+    '''
+    path = fusepath.normalize_path(path)
+    parts = [part for part in path.split('/') if part != '']
+    rows = _query_tree_view(db, "bySubtree",
+                            startkey=parts + [None],
+                            endkey=parts + [{}],
+                            include_docs=include_docs)
+    if rows is not None:
+        if include_docs:
+            return [row.doc for row in rows]
+        else:
+            return [row.value for row in rows]
+
+    docs = []
+    folder_paths = [path]
+    while len(folder_paths) > 0:
+        folder_path = folder_paths.pop()
+        for res in db.view("file/byFolder", key=folder_path):
+            docs.append(res.value)
+        for res in db.view("folder/byFolder", key=folder_path):
+            docs.append(res.value)
+            folder_paths.append(
+                fusepath.join(folder_path, res.value["name"]))
+    return docs
+
+
+def _query_tree_view(db, name, **options):
+    '''
+    Return rows of given view of the tree design document, or None if it is
+    not available. Databases initialized before the tree view existed get it
+    on first use. If it cannot be created, this is remembered so that the
+    missing view is not queried again.
+    '''
+    if db.name in _missing_tree_views:
+        return None
+    try:
+        return list(db.view("tree/%s" % name, **options))
+    except ResourceNotFound:
+        pass
+
+    try:
+        init_tree_view(db)
+        logger.info('[DB] Tree design document created')
+    except ResourceConflict:
+        # Created in the meantime, or an older version without this view.
+        pass
+    except Exception:
+        logger.exception('[DB] Tree design document cannot be created')
+
+    try:
+        return list(db.view("tree/%s" % name, **options))
+    except ResourceNotFound:
+        logger.warn('[DB] Tree view is not available, file and folder '
+                    'views are used instead')
+        _missing_tree_views.add(db.name)
+        return None
+
+
+def get_files_in_folder(db, path):
+    '''
+    Return file documents located in folder of given path and in its
+    subfolders. Every file is added to the file cache.
+    '''
+    file_docs = []
+    for doc in get_subtree(db, path, include_docs=True):
+        if doc["docType"] == "File":
+            file_cache.add(fusepath.join(doc["path"], doc["name"]), doc)
+            file_docs.append(doc)
+    return file_docs
 
-    dirname, filename = (current_file_doc["path"], current_file_doc["name"])
-    oldpath = fusepath.join(dirname, filename)
 
-    file_cache.remove(oldpath)
+def get_folder_size(db, path):
+    '''
+    Return the sum of the sizes of files located under given folder.
+    '''
+    return sum(doc.get("size") or 0 for doc in get_subtree(db, path)
+               if doc["docType"] == "File")
+
+
+@metrics.timed('cozyfuse_db', 'call')
+def update_file(db, file_doc, oldpath=None):
+    '''
+    Save given file with its known revision, the latest revision is fetched
+    only if the save conflicts. Update file cache accordingly. Give oldpath
+    when the file was moved so its previous cache entry is dropped.
+    '''
+    save_doc(db, file_doc)
+
+    dirname, filename = (file_doc["path"], file_doc["name"])
+    newpath = fusepath.join(dirname, filename)
+    if oldpath is not None and oldpath != newpath:
+        file_cache.remove(oldpath)
     file_cache.add(newpath, file_doc)
 
 
+@metrics.timed('cozyfuse_db', 'call')
 def delete_file(db, file_doc):
     '''
     Remove given file document from database and from file cache.
     '''
-    db.delete(db[file_doc["_id"]])
+    delete_doc(db, file_doc["_id"], file_doc.get("_rev"))
 
     dirname, filename = file_doc["path"], file_doc["name"]
     file_cache.remove(fusepath.join(dirname, filename))
 
 
+def save_doc(db, doc):
+    '''
+    Save document with the revision it carries. If it conflicts, the latest
+    revision is fetched and the save is retried: last writer wins. The
+    document gets its new revision so cached copies stay up to date.
+    '''
+    for attempt in range(BULK_RETRIES):
+        try:
+            return db.save(doc)
+        except ResourceConflict:
+            doc["_rev"] = db[doc["_id"]]["_rev"]
+    return db.save(doc)
+
+
+def delete_doc(db, doc_id, rev=None):
+    '''
+    Delete document with given revision. The latest revision is fetched when
+    it is unknown or when the deletion conflicts.
+    '''
+    if rev is None:
+        rev = db[doc_id]["_rev"]
+    for attempt in range(BULK_RETRIES):
+        try:
+            return db.delete({"_id": doc_id, "_rev": rev})
+        except ResourceConflict:
+            rev = db[doc_id]["_rev"]
+    return db.delete({"_id": doc_id, "_rev": rev})
+
+
+@metrics.timed('cozyfuse_db', 'call')
+def bulk_update(db, docs, update, refetch=None):
+    '''
+    Apply update function to given documents then save them with _bulk_docs
+    requests of BULK_SIZE documents. Documents in conflict are fetched
+    again, updated and saved again. Documents deleted in the meantime are
+    skipped. Return saved documents.
+    Every batch is sent even if some documents fail, a BulkUpdateError
+    is raised afterwards.
+    *refetch* takes the id of a document in conflict and returns the
+    document to update again (None if it is deleted), its latest version
+    by default.
+    '''
+    if refetch is None:
+        refetch = db.get
+    saved_docs = []
+    errors = []
+    for start in range(0, len(docs), BULK_SIZE):
+        batch = docs[start:start + BULK_SIZE]
+        for doc in batch:
+            update(doc)
+
+        for attempt in range(BULK_RETRIES + 1):
+            conflicts = []
+            for (doc, (success, doc_id, result)) in \
+                    zip(batch, db.update(batch)):
+                if success:
+                    saved_docs.append(doc)
+                elif isinstance(result, ResourceConflict):
+                    conflicts.append(doc_id)
+                else:
+                    errors.append((doc_id, result))
+
+            batch = []
+            for doc_id in conflicts:
+                doc = refetch(doc_id)
+                if doc is not None:
+                    update(doc)
+                    batch.append(doc)
+            if len(batch) == 0:
+                break
+        else:
+            errors.extend(
+                (doc_id, ResourceConflict('Still in conflict'))
+                for doc_id in conflicts)
+
+    if len(errors) > 0:
+        raise BulkUpdateError(errors, saved_docs)
+    return saved_docs
+
+
+@metrics.timed('cozyfuse_db', 'call')
+def delete_docs(db, docs):
+    '''
+    Delete given file and folder documents, along with the Binary documents
+    of the files, by sending tombstones with _bulk_docs requests. Documents
+    deleted in the meantime are skipped. Caches are updated.
+    '''
+    tombstones = []
+    for doc in docs:
+        tombstones.append({"_id": doc["_id"], "_rev": doc["_rev"]})
+        binary = (doc.get("binary") or {}).get("file")
+        if doc["docType"] == "File" and binary is not None:
+            tombstone = {"_id": binary["id"]}
+            if binary.get("rev") is not None:
+                tombstone["_rev"] = binary["rev"]
+            tombstones.append(tombstone)
+
+    def delete(doc):
+        doc["_deleted"] = True
+
+    def get_tombstone(doc_id):
+        # Tombstones keep only the latest revision, not the document body.
+        doc = db.get(doc_id)
+        if doc is None:
+            return None
+        return {"_id": doc_id, "_rev": doc["_rev"]}
+
+    try:
+        bulk_update(db, tombstones, delete, get_tombstone)
+    finally:
+        for doc in docs:
+            path = fusepath.join(
+                fusepath.normalize_path(doc["path"]), doc["name"])
+            if doc["docType"] == "File":
+                file_cache.remove(path)
+            else:
+                folder_cache.remove(path)
+
+
+@metrics.timed('cozyfuse_db', 'call')
+def move_subtree(db, pathfrom, pathto):
+    '''
+    Move every file and folder located under folder pathfrom to folder
+    pathto with bulk requests. Caches are updated. Return a list of
+    (previous path, document) couples. If some documents could not be
+    moved, the BulkUpdateError raised carries this list for the moved ones
+    as *moved*.
+    '''
+    pathfrom = fusepath.normalize_path(pathfrom)
+    pathto = fusepath.normalize_path(pathto)
+    docs = get_subtree(db, pathfrom, include_docs=True)
+    old_paths = dict(
+        (doc["_id"], fusepath.join(doc["path"], doc["name"])) for doc in docs)
+
+    def move(doc):
+        path = fusepath.normalize_path(doc["path"])
+        if path == pathfrom or path.startswith(pathfrom + '/'):
+            doc["path"] = pathto + path[len(pathfrom):]
+
+    try:
+        saved_docs = bulk_update(db, docs, move)
+        error = None
+    except BulkUpdateError as e:
+        saved_docs = e.saved_docs
+        error = e
+
+    moved = []
+    for doc in saved_docs:
+        old_path = old_paths[doc["_id"]]
+        new_path = fusepath.join(doc["path"], doc["name"])
+        if doc["docType"] == "File":
+            file_cache.remove(old_path)
+            file_cache.add(new_path, doc)
+        else:
+            folder_cache.remove(old_path)
+            folder_cache.add(new_path, doc)
+        moved.append((old_path, doc))
+
+    if error is not None:
+        error.moved = moved
+        raise error
+    return moved
+
+
 def get_random_key():
     '''
     Generate a random key of 20 chars. The first character is not a number
@@ -255,10 +656,11 @@ def create_db_user(database, login, password, protocol="http"):
         "roles": [],
         "password": password
     }
-    requests.post('%s://localhost:5984/_users' % (protocol),
-                  data=json.dumps(data),
-                  headers=headers,
-                  verify=False)
+    session = connection.get_session()
+    session.post('%s://localhost:5984/_users' % (protocol),
+                 data=json.dumps(data),
+                 headers=headers,
+                 verify=False)
 
     headers = {'content-type': 'application/json'}
     data = {
@@ -271,10 +673,10 @@ def create_db_user(database, login, password, protocol="http"):
             "roles": []
         },
     }
-    requests.put('%s://localhost:5984/%s/_security' % (protocol, database),
-                 data=json.dumps(data),
-                 headers=headers,
-                 verify=False)
+    session.put('%s://localhost:5984/%s/_security' % (protocol, database),
+                data=json.dumps(data),
+                headers=headers,
+                verify=False)
     logger.info('[DB] Db user created')
 
 
@@ -282,11 +684,12 @@ def remove_db_user(database):
     '''
     Delete user created for this database.
     '''
-    response = requests.get(
+    session = connection.get_session()
+    response = session.get(
         'http://localhost:5984/_users/org.couchdb.user:%s' % database)
     rev = response.json().get("_rev", "")
 
-    response = requests.delete(
+    response = session.delete(
         'http://localhost:5984/_users/org.couchdb.user:%s?rev=%s' %
         (database, rev)
     )
@@ -329,11 +732,135 @@ def init_database_view(docType, db):
     }
 
 
+def init_tree_view(db):
+    '''
+    Add views listing files and folders:
+        * byParent: children of a folder in a single query. Only the fields
+          required by file attributes are emitted, to keep responses and
+          view index small.
+        * bySubtree: keys are full path components, so that all descendants
+          of a folder are returned by a single range query.
+    '''
+    db["_design/tree"] = {
+        "views": {
+            "byParent": {
+                "map": """function (doc) {
+                  if (doc.docType === "File" || doc.docType === "Folder") {
+                      emit(doc.path, {
+                          name: doc.name,
+                          docType: doc.docType,
+                          size: doc.size,
+                          lastModification: doc.lastModification
+                      });
+                  }
+                }"""
+            },
+            "bySubtree": {
+                "map": """function (doc) {
+                  if (doc.docType === "File" || doc.docType === "Folder") {
+                      var parts = doc.path.split('/').filter(function (part) {
+                          return part !== '';
+                      });
+                      parts.push(doc.name);
+                      emit(parts, {
+                          name: doc.name,
+                          path: doc.path,
+                          docType: doc.docType,
+                          size: doc.size,
+                          lastModification: doc.lastModification,
+                          binary: doc.binary && doc.binary.file ?
+                              doc.binary.file.id : null
+                      });
+                  }
+                }"""
+            }
+        }
+    }
+
+
+def init_progress_view(db):
+    '''
+    Add reduce views used to report synchronization progress:
+        * count: number of documents by docType (files and binaries).
+        * size: bytes of files and of binaries, by docType.
+        * storedSize: bytes of files stored by each device.
+    '''
+    db["_design/progress"] = {
+        "views": {
+            "count": {
+                "map": """function (doc) {
+                              if (doc.docType === \"File\" ||
+                                  doc.docType === \"Binary\") {
+                                  emit(doc.docType, null);
+                              }
+                          }""",
+                "reduce": "_count"
+            },
+            "size": {
+                "map": """function (doc) {
+                              if (doc.docType === \"File\") {
+                                  emit(doc.docType, doc.size || 0);
+                              } else if (doc.docType === \"Binary\" &&
+                                         doc._attachments &&
+                                         doc._attachments.file) {
+                                  emit(doc.docType,
+                                       doc._attachments.file.length || 0);
+                              }
+                          }""",
+                "reduce": "_sum"
+            },
+            "storedSize": {
+                "map": """function (doc) {
+                              if (doc.docType === \"File\" && doc.storage) {
+                                  for (var i = 0; i < doc.storage.length;
+                                       i++) {
+                                      emit(doc.storage[i], doc.size || 0);
+                                  }
+                              }
+                          }""",
+                "reduce": "_sum"
+            }
+        }
+    }
+
+
+@metrics.timed('cozyfuse_db', 'call')
+def get_progress(db, device):
+    '''
+    Return number of files and binaries, total size of files and size of
+    files stored by given device. Each figure is read from a reduce view in
+    a single small response. Views are created for databases initialized
+    before they existed.
+    '''
+    try:
+        (counts, sizes, stored) = _query_progress(db, device)
+    except ResourceNotFound:
+        init_progress_view(db)
+        (counts, sizes, stored) = _query_progress(db, device)
+
+    return {
+        'files': counts.get('File', 0),
+        'binaries': counts.get('Binary', 0),
+        'bytes': sizes.get('File', 0),
+        'bytes_cached': stored[0] if len(stored) > 0 else 0,
+    }
+
+
+def _query_progress(db, device):
+    counts = dict((row.key, row.value)
+                  for row in db.view('progress/count', group=True))
+    sizes = dict((row.key, row.value)
+                 for row in db.view('progress/size', group=True))
+    stored = [row.value
+              for row in db.view('progress/storedSize', key=device)]
+    return (counts, sizes, stored)
+
+
 def init_database_views(database):
     '''
     Initialize database:
         * Create database
-        * Initialize folder, file, binary and device views
+        * Initialize folder, file, tree, binary and device views
     '''
     db = get_db(database, credentials=False)
 
@@ -349,6 +876,12 @@ def init_database_views(database):
     except ResourceConflict:
         logger.warn('[DB] File design document already exists')
 
+    try:
+        init_tree_view(db)
+        logger.info('[DB] Tree design document created')
+    except ResourceConflict:
+        logger.warn('[DB] Tree design document already exists')
+
     try:
         db["_design/device"] = {
             "views": {
@@ -388,6 +921,12 @@ def init_database_views(database):
     except ResourceConflict:
         logger.warn('[DB] Binary design document already exists')
 
+    try:
+        init_progress_view(db)
+        logger.info('[DB] Progress design document created')
+    except ResourceConflict:
+        logger.warn('[DB] Progress design document already exists')
+
 
 def init_device(database, url, path, device_pwd, device_id):
     '''
@@ -450,7 +989,8 @@ def get_disk_space(database, url, device, device_password):
     url = url.split('/')
     try:
         remote = "https://%s:%s@%s" % (device, device_password, url[2])
-        response = requests.get('%s/disk-space'%remote)
+        response = connection.get_session(database).get(
+            '%s/disk-space' % remote)
         disk_space = json.loads(response.content)
         # Store disk space
         res = db.view('device/all')
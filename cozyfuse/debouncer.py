@@ -0,0 +1,56 @@
+import threading
+
+# Time (s) during which successive updates of the same key are coalesced.
+WINDOW = 2
+
+
+class Debouncer:
+    '''
+    Coalesce updates made on the same key during a time window. The first
+    update of a window starts a timer, when it expires the last value of
+    every updated key is given to the flush function in a single call.
+    '''
+
+    def __init__(self, flush, window=WINDOW):
+        '''
+        *flush* takes a dict of keys and their last values. *window* is the
+        delay in seconds before pending updates are flushed, updates are
+        flushed immediately if it is 0.
+        '''
+        self.flush_function = flush
+        self.window = window
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, key, value):
+        '''
+        Record new value of key, it replaces the value pending for the same
+        key.
+        '''
+        with self._lock:
+            self._pending[key] = value
+            if self.window > 0 and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if self.window <= 0:
+            self.flush()
+
+    def flush(self):
+        '''
+        Give every pending update to the flush function now.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if len(pending) > 0:
+                self.flush_function(pending)
+
+    def __len__(self):
+        return len(self._pending)
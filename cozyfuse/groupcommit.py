@@ -0,0 +1,92 @@
+import threading
+import time
+
+# Time (s) the leader of a batch waits for other writers before committing.
+WINDOW = 0.005
+MAX_BATCH_SIZE = 500
+
+
+class _Request:
+
+    def __init__(self, item):
+        self.item = item
+        self.leader = False
+        self.done = False
+        self.result = None
+        self.error = None
+        self.wakeup = threading.Event()
+
+
+class GroupCommit:
+    '''
+    Gather items submitted by concurrent threads and commit them together.
+    The first writer becomes the leader of the batch: it waits for *window*
+    seconds, then commits every pending item with a single call to the
+    commit function. Other writers wait until their batch is committed.
+    Items submitted while a batch is committed form the next batch, so the
+    number of commits depends on the batch size, not on the number of items.
+    '''
+
+    def __init__(self, commit, window=WINDOW, max_size=MAX_BATCH_SIZE):
+        '''
+        *commit* takes a list of items and returns a list of the same length.
+        Each result is given back to the writer of the item, or raised if it
+        is an exception.
+        '''
+        self.commit = commit
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._leading = False
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        '''
+        Queue item and wait until it is committed. Return its result.
+        '''
+        request = _Request(item)
+        with self._lock:
+            self._pending.append(request)
+            if not self._leading:
+                self._leading = True
+                request.leader = True
+
+        if not request.leader:
+            request.wakeup.wait()
+        if not request.done:
+            # Request was promoted as leader of the next batch.
+            self._lead()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _lead(self):
+        if self.window > 0:
+            time.sleep(self.window)
+        with self._lock:
+            batch = self._pending[:self.max_size]
+            del self._pending[:self.max_size]
+
+        try:
+            results = self.commit([request.item for request in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (request, result) in zip(batch, results):
+            if isinstance(result, Exception):
+                request.error = result
+            else:
+                request.result = result
+            request.done = True
+
+        with self._lock:
+            if len(self._pending) > 0:
+                next_leader = self._pending[0]
+                next_leader.leader = True
+                next_leader.wakeup.set()
+            else:
+                self._leading = False
+
+        for request in batch:
+            request.wakeup.set()
@@ -1,12 +1,18 @@
 import os
+import Queue
+import random
 import shutil
 import daemon
 import lockfile
 import logging
+import functools
+import threading
 
 from yaml import load, dump
 from yaml import Loader
 
+import cache
+
 
 CONFIG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
 # Create config folder if it doesn't exist.
@@ -18,6 +24,14 @@ CONFIG_PATH = os.path.join(CONFIG_FOLDER, 'config.yaml')
 HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
 HDLR.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 
+# Log levels, ex: "warning,couchmount=debug" sets the default level to
+# WARNING and the level of the couchmount module to DEBUG.
+LOG_LEVELS = os.environ.get('COZYFUSE_LOG', 'info')
+
+# Ratio of file system operations traced (0 disables tracing, 1 traces all
+# of them).
+TRACE_RATE = float(os.environ.get('COZYFUSE_TRACE', 0))
+
 logger = logging.getLogger(__name__)
 
 
@@ -236,7 +250,118 @@ def get_daemon_context(device_name, daemon_name, files_preserve=[]):
     )
 
 
+class QueueHandler(logging.Handler):
+    '''
+    Put log records in a queue, a background thread writes them with the
+    given handler. This way logging never waits for the disk. Messages are
+    formatted by the background thread too. The thread is started again if
+    the process was forked (FUSE daemonizes after the loggers are set up).
+    '''
+
+    def __init__(self, handler):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue = Queue.Queue()
+        self._pid = None
+        self._listener_lock = threading.Lock()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        if record.exc_info:
+            # Traceback is formatted now, it may not be available later.
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.queue.put(record)
+
+    def flush(self):
+        '''
+        Wait until every queued record is written.
+        '''
+        if self._pid == os.getpid():
+            self.queue.join()
+        self.handler.flush()
+
+    def _start_listener(self):
+        with self._listener_lock:
+            if self._pid == os.getpid():
+                return
+            # Records queued by the parent process are left to it.
+            self._pid = os.getpid()
+            self.queue = Queue.Queue()
+            thread = threading.Thread(target=self._listen)
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.handler.handle(record)
+            finally:
+                self.queue.task_done()
+
+
+QUEUE_HDLR = QueueHandler(HDLR)
+
+
+def get_log_level(name, levels=None):
+    '''
+    Return the log level of given module according to the COZYFUSE_LOG
+    environment variable.
+    '''
+    if levels is None:
+        levels = LOG_LEVELS
+    level = logging.INFO
+    module = name.split('.')[-1]
+    module_level = None
+    for setting in levels.split(','):
+        if '=' in setting:
+            (setting_module, setting_level) = setting.split('=', 1)
+            if setting_module.strip() in (name, module):
+                module_level = _parse_level(setting_level, module_level)
+        else:
+            level = _parse_level(setting, level)
+    if module_level is not None:
+        return module_level
+    return level
+
+
+def _parse_level(name, default):
+    level = logging.getLevelName(name.strip().upper())
+    if isinstance(level, int):
+        return level
+    return default
+
+
 def configure_logger(log):
-    log.addHandler(HDLR)
-    log.setLevel(logging.INFO)
+    log.addHandler(QUEUE_HDLR)
+    log.setLevel(get_log_level(log.name))
     log.propagate = False
+
+
+def traced(log, rate=None):
+    '''
+    Decorator that logs arguments, result and duration of a sampled part of
+    the calls made to the decorated method. *rate* defaults to TRACE_RATE.
+    '''
+    if rate is None:
+        rate = TRACE_RATE
+
+    def decorator(function):
+        if rate <= 0:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if random.random() >= rate:
+                return function(*args, **kwargs)
+            start = cache.clock()
+            result = function(*args, **kwargs)
+            log.info('[Trace] %s%.200r -> %.200r (%.3f ms)',
+                     function.__name__, args[1:], result,
+                     (cache.clock() - start) * 1000)
+            return result
+        return wrapper
+    return decorator
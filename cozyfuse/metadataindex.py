@@ -0,0 +1,194 @@
+import json
+import sqlite3
+import threading
+import logging
+
+import fusepath
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+PAGE_SIZE = 1000
+
+DOC_TYPES = ['File', 'Folder']
+
+
+class MetadataIndex:
+    '''
+    Local copy of file and folder metadata stored in a SQLite database. Every
+    entry maps a full path to the fields required to build file attributes.
+    The index is kept up to date by reading the changes feed of the local
+    CouchDB database (see sync and apply_changes), the last sequence number
+    read is stored with the data so a restart continues from where the index
+    stopped.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Open (and create if needed) the index database located at filename.
+        '''
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                id TEXT PRIMARY KEY,
+                path TEXT,
+                parent TEXT,
+                name TEXT,
+                type TEXT,
+                size INTEGER,
+                lastModification TEXT
+            );
+            CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        self._conn.commit()
+        seq = self._get_checkpoint('seq')
+        if seq is None:
+            self.seq = None
+        else:
+            self.seq = json.loads(seq)
+        self.ready = self._get_checkpoint('ready') == '1'
+
+    def is_ready(self):
+        '''
+        Return True once the index was fully synchronized at least once.
+        '''
+        return self.ready
+
+    def get(self, path):
+        '''
+        Return entry (as a dict) located at given path, None if there is no
+        such entry.
+        '''
+        path = fusepath.normalize_path(path)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT type, name, size, lastModification FROM entries '
+                'WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        else:
+            return self._to_entry(row)
+
+    def get_path(self, doc_id):
+        '''
+        Return path of document with given id, None if it is not indexed.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path FROM entries WHERE id = ?', (doc_id,)).fetchone()
+        if row is None:
+            return None
+        else:
+            return row[0]
+
+    def list(self, path):
+        '''
+        Return entries located in folder of given path.
+        '''
+        path = fusepath.normalize_path(path)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT type, name, size, lastModification FROM entries '
+                'WHERE parent = ? ORDER BY name', (path,)).fetchall()
+        return [self._to_entry(row) for row in rows]
+
+    def update_doc(self, doc):
+        '''
+        Add or update entry matching given File or Folder document.
+        '''
+        with self._lock:
+            self._update_doc(doc)
+            self._conn.commit()
+
+    def remove(self, doc_id):
+        '''
+        Remove entry of document with given id.
+        '''
+        with self._lock:
+            self._conn.execute('DELETE FROM entries WHERE id = ?', (doc_id,))
+            self._conn.commit()
+
+    def apply_changes(self, results, last_seq, complete=False):
+        '''
+        Apply given changes feed results to the index then save last sequence
+        number. When complete is True, the index is marked as ready.
+        '''
+        with self._lock:
+            for line in results:
+                if line.get('deleted', False) or line.get('doc') is None:
+                    self._conn.execute(
+                        'DELETE FROM entries WHERE id = ?', (line['id'],))
+                else:
+                    self._update_doc(line['doc'])
+            self._set_checkpoint('seq', json.dumps(last_seq))
+            if complete:
+                self._set_checkpoint('ready', '1')
+            self._conn.commit()
+        self.seq = last_seq
+        if complete:
+            self.ready = True
+
+    def sync(self, db):
+        '''
+        Read all changes that occured since last synchronization and apply
+        them to the index.
+        '''
+        while True:
+            changes = db.changes(since=self.seq or 0, include_docs=True,
+                                 limit=PAGE_SIZE)
+            results = changes['results']
+            complete = len(results) < PAGE_SIZE
+            self.apply_changes(results, changes['last_seq'], complete)
+            if complete:
+                return
+
+    def close(self):
+        '''
+        Close connection to the index database.
+        '''
+        with self._lock:
+            self._conn.close()
+
+    def _update_doc(self, doc):
+        if doc.get('docType') not in DOC_TYPES:
+            return
+        parent = fusepath.normalize_path(doc['path'])
+        path = fusepath.join(parent, doc['name'])
+        self._conn.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                doc['_id'],
+                path,
+                parent,
+                doc['name'],
+                doc['docType'],
+                doc.get('size'),
+                doc.get('lastModification')
+            ))
+
+    def _to_entry(self, row):
+        entry = {'docType': row[0], 'name': row[1]}
+        if row[2] is not None:
+            entry['size'] = row[2]
+        if row[3] is not None:
+            entry['lastModification'] = row[3]
+        return entry
+
+    def _get_checkpoint(self, key):
+        row = self._conn.execute(
+            'SELECT value FROM checkpoint WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        else:
+            return row[0]
+
+    def _set_checkpoint(self, key, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO checkpoint VALUES (?, ?)', (key, value))
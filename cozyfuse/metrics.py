@@ -0,0 +1,180 @@
+import os
+import bisect
+import functools
+import threading
+
+import cache
+
+# Upper bounds (s) of latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+clock = cache.clock
+
+_counters = {}
+_histograms = {}
+_caches = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    '''
+    Count observed values by bucket, along with their sum.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def increment(name, value=1, **labels):
+    '''
+    Add value to the counter of given name and labels.
+    '''
+    key = (name, _get_labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    '''
+    Record value in the histogram of given name and labels.
+    '''
+    key = (name, _get_labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            _histograms[key] = histogram
+        histogram.observe(value)
+
+
+def timed(name, label='op', value=None):
+    '''
+    Decorator that records the duration of every call in histogram
+    *name*_seconds and counts failed calls in counter *name*_errors. The
+    call is identified by the *label* label, its value is the function name
+    by default. Calls raising an exception or returning a negative error
+    code (FUSE convention) are failures.
+    '''
+
+    def decorator(function):
+        labels = {label: value or function.__name__}
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = isinstance(result, int) and result < 0
+                return result
+            finally:
+                observe(name + '_seconds', clock() - start, **labels)
+                if failed:
+                    increment(name + '_errors', **labels)
+        return wrapper
+    return decorator
+
+
+def register_cache(name, cache):
+    '''
+    Report hits, misses and size of given cache.
+    '''
+    with _lock:
+        _caches[name] = cache
+
+
+def reset():
+    '''
+    Forget every recorded value.
+    '''
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _caches.clear()
+
+
+def render():
+    '''
+    Return metrics in the Prometheus text format.
+    '''
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(
+            (key, (list(histogram.counts), histogram.sum, histogram.count))
+            for (key, histogram) in _histograms.items())
+        caches = sorted(_caches.items())
+
+    lines = []
+    declared = set()
+
+    def declare(name, metric_type):
+        if name not in declared:
+            declared.add(name)
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+    for ((name, labels), value) in counters:
+        declare(name + '_total', 'counter')
+        lines.append('%s_total%s %s' % (name, _format_labels(labels), value))
+
+    for ((name, labels), (counts, total, count)) in histograms:
+        declare(name, 'histogram')
+        cumulated = 0
+        for (bound, bucket_count) in zip(BUCKETS + ('+Inf',), counts):
+            cumulated += bucket_count
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labels + (('le', bound),)), cumulated))
+        lines.append('%s_sum%s %f' % (name, _format_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+
+    cache_stats = []
+    for (cache_name, cache) in caches:
+        stats = cache.stats()
+        requests = stats['hits'] + stats['misses']
+        if requests > 0:
+            stats['hit_ratio'] = float(stats['hits']) / requests
+        else:
+            stats['hit_ratio'] = 0.0
+        cache_stats.append(
+            (_format_labels((('cache', cache_name),)), stats))
+
+    for (key, name, metric_type) in [
+            ('hits', 'cozyfuse_cache_hits_total', 'counter'),
+            ('misses', 'cozyfuse_cache_misses_total', 'counter'),
+            ('evictions', 'cozyfuse_cache_evictions_total', 'counter'),
+            ('size', 'cozyfuse_cache_size', 'gauge'),
+            ('hit_ratio', 'cozyfuse_cache_hit_ratio', 'gauge')]:
+        for (labels, stats) in cache_stats:
+            declare(name, metric_type)
+            lines.append('%s%s %s' % (name, labels, stats[key]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def dump(filename):
+    '''
+    Write metrics to given file. The file is replaced atomically so it can
+    be read at any time.
+    '''
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as metrics_file:
+        metrics_file.write(render())
+    os.rename(tmp_filename, filename)
+
+
+def _get_labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value)
+                             for (key, value) in labels)
@@ -1,7 +1,7 @@
 import logging
-import requests
 
 import local_config
+import connection
 
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
@@ -26,7 +26,7 @@ def register_device(name, url, path, password):
     configuration file.
     '''
     data = {'login': name, 'folder': path}
-    response = requests.post(
+    response = connection.get_session(name).post(
         '%s/device/' % url,
         data=data,
         auth=('owner', password),
@@ -63,8 +63,9 @@ def remove_device(url, device_id, password):
     '''
     Remove device from its Cozy.
     '''
-    response = requests.delete('%s/device/%s/' % (url, device_id),
-                               auth=('owner', password), verify=False)
+    response = connection.get_session().delete(
+        '%s/device/%s/' % (url, device_id),
+        auth=('owner', password), verify=False)
 
     logger.info('[Remote config] Device deletion succeeded for %s.' % url)
     return response
@@ -1,16 +1,37 @@
+import os
 import json
-import requests
 import logging
 import time
+import threading
+import Queue
 
 import dbutils
 import local_config
+import connection
+import changes
+import debouncer
+import transfers
 
-from couchdb import Server, http
+from couchdb import http
 
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
+# Number of changes read at once from the changes feed while catching up.
+PAGE_SIZE = 500
+
+# Maximum number of binaries fetched by a single replication.
+REPLICATION_BATCH_SIZE = 100
+
+# Local (not replicated) document storing the binary replication progress.
+CHECKPOINT_ID = '_local/binary-sync'
+
+# Delay (s) before binaries that failed to replicate are replicated again.
+RETRY_DELAY = 30
+
+# Minimum delay (s) between two writes of the checkpoint document.
+CHECKPOINT_INTERVAL = 10
+
 
 def replicate(database, url, device, device_password, device_id,
               db_login, db_password,
@@ -43,7 +64,7 @@ def replicate(database, url, device, device_password, device_id,
     local = 'http://%s:%s@localhost:5984/%s' % \
             (db_login, db_password, database)
     remote = "https://%s:%s@%s/cozy" % (device, device_password, url[2])
-    server = Server('http://localhost:5984/')
+    server = connection.get_server()
 
     if to_local:
         target = local
@@ -85,7 +106,7 @@ def get_progression():
     Recover progression of metadata replication
     '''
     url = 'http://localhost:5984/_active_tasks'
-    response = requests.get(url)
+    response = connection.get_session().get(url)
     replications = json.loads(response.content)
     prog = 0
     for rep in replications:
@@ -99,13 +120,19 @@ def get_binary_progression(database):
     '''
     Recover progression of binary downloads.
     '''
-    db = dbutils.get_db(database)
-    files = db.view("file/all")
-    binaries = db.view('binary/all')
-    if len(files) is 0:
+    progress = get_progress(database)
+    if progress['files'] == 0:
         return 1
     else:
-        return len(binaries)/float(len(files))
+        return progress['binaries'] / float(progress['files'])
+
+
+def get_progress(database):
+    '''
+    Return number of files, number of binaries, total size of files and size
+    of files stored locally for given device.
+    '''
+    return dbutils.get_progress(dbutils.get_db(database), database)
 
 
 class BinaryReplication():
@@ -122,77 +149,194 @@ class BinaryReplication():
             local_config.get_db_credentials(db_name)
         (self.db, self.server) = dbutils.get_db_and_server(db_name)
         self.db_name = db_name
+        # Binaries are replicated in background, after interactive
+        # downloads of the mounted device.
+        self.transfers = transfers.TransferScheduler(
+            activity_file=os.path.join(
+                local_config.CONFIG_FOLDER, db_name, transfers.ACTIVITY_FILE))
         self.replicate_file_changes()
 
     def replicate_file_changes(self):
         '''
         Replicate all changes related to files and binaries to stored devices.
+        Changes missed while the device was offline are processed page by
+        page, then new changes are received through the continuous changes
+        feed and related binaries are fetched by a worker thread in batches.
         '''
         device = dbutils.get_device(self.db_name)
         self.urlCozy = device['url']
         self.loginCozy = device['login']
         self.passwordCozy = device['password']
 
-        # Initialize sequence number to avoid full replication
-        # every time.
-        if 'seq' not in device:
-            device['seq'] = 0
-        new_seq = device['seq']
+        # Start from the last saved sequence number to avoid full
+        # replication every time.
+        self.seq = self._load_seq(device)
+        self.checkpoints = debouncer.Debouncer(
+            self._write_checkpoint, window=CHECKPOINT_INTERVAL)
+        try:
+            self._follow_file_changes()
+        finally:
+            self.checkpoints.flush()
+
+    def _follow_file_changes(self):
+        '''
+        Process changes missed since last checkpoint then listen to new ones.
+        '''
+        self._catch_up()
+
+        # Bounded, so a burst of changes doesn't pile up in memory while
+        # binaries are replicated.
+        self.pending = Queue.Queue(maxsize=PAGE_SIZE)
+        worker = threading.Thread(target=self._replicate_pending)
+        worker.daemon = True
+        worker.start()
+
+        listener = changes.ChangesListener(
+            self.db, since=self.seq, filter='file/all')
+        listener.subscribe(self._on_file_change)
+        listener.run()
+
+    def _catch_up(self):
+        '''
+        Process file changes that occured since last saved sequence number by
+        pages of PAGE_SIZE changes. Sequence number is saved after each page
+        so an interrupted catch up resumes where it stopped.
+        '''
+        while True:
+            page = self.db.changes(since=self.seq, filter='file/all',
+                                   include_docs=True, limit=PAGE_SIZE)
+            results = page['results']
+            binary_ids = [self._handle_change(line) for line in results]
+            self._replicate_all(binary_ids)
+            self._save_seq(page['last_seq'])
+            logger.info('[Replication] %d file changes processed, '
+                        'sequence number: %s', len(results), self.seq)
+            if len(results) < PAGE_SIZE:
+                return
+
+    def _on_file_change(self, line):
+        '''
+        Queue binary of changed file for replication.
+        '''
+        self.pending.put((self._handle_change(line), line['seq']))
 
-        # We create an infinite loop which will get file changes
-        # every 10 seconds, and fetch related binaries if needed.
+    def _handle_change(self, line):
+        '''
+        Delete local binary of a deleted file. Return the binary id of a
+        created or updated file, None otherwise.
+        '''
+        doc = line['doc']
+        if self._is_deleted(line):
+            logger.info("Deleting file %s...", line['id'])
+            try:
+                # Delete file locally
+                self.db.delete(self.db[doc['binary']['file']['id']])
+            except (http.ResourceNotFound, KeyError):
+                # Already deleted
+                pass
+            return None
+
+        if self._is_new(line):
+            logger.info("Creating file %s...", doc['name'])
+        else:
+            logger.info("Updating file %s...", doc['name'])
+        if 'binary' in doc:
+            return doc['binary']['file']['id']
+        return None
+
+    def _replicate_pending(self):
+        '''
+        Wait for queued changes, replicate their binaries by batches then
+        record the last sequence number.
+        '''
         while True:
-            changes = self.db.changes(since=device['seq'],
-                                      filter='file/all',
-                                      include_docs=True)
-
-            binary_ids = []
-
-            # Iterate over changes
-            for line in changes['results']:
-
-                # Save last sequence number
-                new_seq = line['seq']
-
-                # Find related binary and add its ID to the list
-                # of files to replicate.
-                doc = line['doc']
-                if self._is_deleted(line):
-                    logger.info("Deleting file %s..." % line['id'])
-                    try:
-                        # Delete file locally
-                        self.db.delete(self.db[doc['binary']['file']['id']])
-                    except http.ResourceNotFound:
-                        # Already deleted
-                        pass
-                elif self._is_new(line):
-                    logger.info("Creating file %s..." % doc['name'])
-                else:
-                    logger.info("Updating file %s..." % doc['name'])
-                if 'binary' in doc:
-                    binary_ids.append(doc['binary']['file']['id'])
-
-            # Replicate related binaries
-            if len(binary_ids) > 0:
+            batch = [self.pending.get()]
+            while len(batch) < PAGE_SIZE:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except Queue.Empty:
+                    break
+            self._replicate_all(
+                [binary_id for (binary_id, seq) in batch])
+            self._save_seq(batch[-1][1])
+
+    def _replicate_all(self, binary_ids):
+        '''
+        Replicate given binaries, failed ones are replicated again every
+        RETRY_DELAY seconds. The sequence number is only saved afterwards,
+        this way binaries are never skipped, even after a restart.
+        '''
+        failed = self._replicate_binaries(binary_ids)
+        while len(failed) > 0:
+            logger.info('[Replication] %d binaries will be replicated again '
+                        'in %d seconds', len(failed), RETRY_DELAY)
+            time.sleep(RETRY_DELAY)
+            failed = self._replicate_binaries(failed)
+
+    def _replicate_binaries(self, binary_ids):
+        '''
+        Replicate given binaries to local database, REPLICATION_BATCH_SIZE
+        binaries at a time, in a background transfer. The transfer
+        checkpoints between two batches, so interactive transfers do not wait
+        for the whole replication. None values are ignored. Return ids of
+        binaries that failed to replicate.
+        '''
+        binary_ids = sorted(set(
+            binary_id for binary_id in binary_ids if binary_id is not None))
+
+        def replicate(transfer):
+            failed = []
+            for i in range(0, len(binary_ids), REPLICATION_BATCH_SIZE):
+                if i > 0:
+                    transfer.checkpoint()
+                ids = binary_ids[i:i + REPLICATION_BATCH_SIZE]
                 try:
-                    self._replicate_to_local(binary_ids)
+                    self._replicate_to_local(ids)
                 except http.ResourceConflict:
                     #TODO: Handle comparison
                     pass
-                except:
-                    logging.exception(
-                        'An error occured while replicating doc %s'
-                        % line['id']
-                    )
-
-            # Save last sequence number along with the device
-            if new_seq != device['seq']:
-                device = dbutils.get_device(self.db_name)
-                device['seq'] = new_seq
-                self.db.save(device)
-
-            # Wait until further potential changes
-            time.sleep(10)
+                except Exception:
+                    logger.exception(
+                        'An error occured while replicating binaries %s', ids)
+                    failed.extend(ids)
+            return failed
+
+        if len(binary_ids) == 0:
+            return []
+        return self.transfers.run(
+            tuple(binary_ids), replicate, transfers.BACKGROUND)
+
+    def _load_seq(self, device):
+        '''
+        Return the sequence number stored in the checkpoint document. Devices
+        synchronized before checkpoints existed have it on their device
+        document.
+        '''
+        self.checkpoint = self.db.get(CHECKPOINT_ID)
+        if self.checkpoint is not None:
+            return self.checkpoint['seq']
+        self.checkpoint = {'_id': CHECKPOINT_ID}
+        return device.get('seq', 0)
+
+    def _save_seq(self, seq):
+        '''
+        Record last processed sequence number. It is written to the checkpoint
+        document at most once every CHECKPOINT_INTERVAL seconds.
+        '''
+        if seq != self.seq:
+            self.seq = seq
+            self.checkpoints.add('seq', seq)
+
+    def _write_checkpoint(self, pending):
+        '''
+        Save sequence number in the checkpoint document. As a local document
+        it is not replicated to the Cozy.
+        '''
+        self.checkpoint['seq'] = pending['seq']
+        try:
+            dbutils.save_doc(self.db, self.checkpoint)
+        except Exception:
+            logger.exception('Sequence number could not be saved')
 
     def _is_new(self, line):
         '''
@@ -0,0 +1,205 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+
+import cache
+
+# Priority classes, lower values run first.
+INTERACTIVE = 0
+PREFETCH = 1
+BACKGROUND = 2
+
+# Number of transfers running at the same time.
+MAX_TRANSFERS = 1
+
+# Prefetch and background transfers of other processes hold back during
+# ACTIVITY_DELAY seconds after an interactive transfer, they check it every
+# ACTIVITY_POLL seconds. Interactive transfers touch the activity file at
+# most every ACTIVITY_MARK_INTERVAL seconds, often enough for the file to
+# never look idle while they run.
+ACTIVITY_FILE = 'interactive'
+ACTIVITY_DELAY = 2
+ACTIVITY_POLL = 0.5
+ACTIVITY_MARK_INTERVAL = ACTIVITY_DELAY / 2.0
+
+
+class Transfer:
+    '''
+    A transfer queued or running in the scheduler. Requests made for the
+    same key while it is pending share it.
+    '''
+
+    def __init__(self, scheduler, key, function, priority):
+        self.scheduler = scheduler
+        self.key = key
+        self.function = function
+        self.priority = priority
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self._entry = None
+
+    def checkpoint(self):
+        '''
+        Called by long transfers between two chunks of data. If a transfer of
+        higher priority waits for a slot, this one gives its slot back and
+        blocks until it gets one again. A non interactive transfer also
+        pauses while interactive transfers of other processes are running.
+        '''
+        self.scheduler._yield(self)
+
+
+class TransferScheduler:
+    '''
+    Run transfers by priority with at most *max_transfers* of them at the
+    same time. Transfers are run by the thread that submitted them, a
+    transfer submitted for a key already pending is merged with the pending
+    one (and takes its priority if it is higher).
+    '''
+
+    def __init__(self, max_transfers=MAX_TRANSFERS, activity_file=None):
+        '''
+        *activity_file* is touched by interactive transfers, prefetch and
+        background transfers wait until it is left untouched during
+        ACTIVITY_DELAY. It coordinates schedulers of different processes for
+        the same device (mount, cache commands and synchronization).
+        '''
+        self.max_transfers = max(1, max_transfers)
+        self.activity_file = activity_file
+        self._queue = []
+        self._pending = {}
+        self._running = set()
+        self._order = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._last_mark = None
+
+    def run(self, key, function, priority=INTERACTIVE):
+        '''
+        Run function(transfer) once a slot is available for it and return
+        its result. Exceptions raised by function are raised again to every
+        request of the transfer.
+        '''
+        with self._condition:
+            transfer = self._pending.get(key)
+            owner = transfer is None
+            if owner:
+                transfer = Transfer(self, key, function, priority)
+                self._pending[key] = transfer
+                self._push(transfer)
+            elif priority < transfer.priority:
+                transfer.priority = priority
+                if transfer not in self._running:
+                    self._push(transfer)
+                    self._condition.notify_all()
+
+        if owner:
+            self._execute(transfer)
+        transfer.done.wait()
+        if transfer.error is not None:
+            raise transfer.error
+        return transfer.result
+
+    def _execute(self, transfer):
+        if transfer.priority != INTERACTIVE:
+            self._wait_for_inactivity(transfer)
+        self._acquire(transfer)
+        try:
+            if transfer.priority == INTERACTIVE:
+                self._mark_activity()
+            transfer.result = transfer.function(transfer)
+        except Exception as e:
+            transfer.error = e
+        finally:
+            with self._condition:
+                self._running.discard(transfer)
+                del self._pending[transfer.key]
+                self._condition.notify_all()
+            transfer.done.set()
+
+    def _push(self, transfer):
+        transfer._entry = (transfer.priority, next(self._order), transfer)
+        heapq.heappush(self._queue, transfer._entry)
+
+    def _get_next(self):
+        '''
+        Return the first queued transfer, dropping entries replaced by a
+        priority change.
+        '''
+        while len(self._queue) > 0 and \
+                self._queue[0] is not self._queue[0][2]._entry:
+            heapq.heappop(self._queue)
+        if len(self._queue) > 0:
+            return self._queue[0][2]
+        return None
+
+    def _acquire(self, transfer):
+        with self._condition:
+            while len(self._running) >= self.max_transfers or \
+                    self._get_next() is not transfer:
+                self._condition.wait()
+            heapq.heappop(self._queue)
+            transfer._entry = None
+            self._running.add(transfer)
+
+    def _yield(self, transfer):
+        if transfer.priority != INTERACTIVE:
+            self._wait_for_inactivity(transfer)
+        if transfer.priority == INTERACTIVE:
+            self._mark_activity()
+        with self._condition:
+            waiting = self._get_next()
+            if waiting is None or waiting.priority >= transfer.priority:
+                return
+            self._running.discard(transfer)
+            self._push(transfer)
+            self._condition.notify_all()
+        self._acquire(transfer)
+
+    def _mark_activity(self):
+        '''
+        Touch activity file, unless it was touched less than
+        ACTIVITY_MARK_INTERVAL seconds ago.
+        '''
+        now = cache.clock()
+        if self._last_mark is not None and \
+                now - self._last_mark < ACTIVITY_MARK_INTERVAL:
+            return
+        self._last_mark = now
+        mark_activity(self.activity_file)
+
+    def _wait_for_inactivity(self, transfer):
+        '''
+        Wait for inactivity of other processes, unless transfer becomes
+        interactive meanwhile.
+        '''
+        wait_for_inactivity(
+            self.activity_file,
+            interrupted=lambda: transfer.priority == INTERACTIVE)
+
+
+def mark_activity(filename):
+    '''
+    Touch activity file.
+    '''
+    if filename is not None:
+        with open(filename, 'a'):
+            os.utime(filename, None)
+
+
+def wait_for_inactivity(filename, delay=ACTIVITY_DELAY, interrupted=None):
+    '''
+    Wait until activity file has not been touched for *delay* seconds, or
+    until *interrupted* (a function checked at every poll) returns True.
+    '''
+    while filename is not None:
+        if interrupted is not None and interrupted():
+            return
+        try:
+            idle = time.time() - os.path.getmtime(filename)
+        except OSError:
+            return
+        if idle >= delay:
+            return
+        time.sleep(min(delay - idle, ACTIVITY_POLL))
@@ -0,0 +1,184 @@
+import os
+import json
+import errno
+import Queue
+import threading
+import weakref
+import logging
+
+import dbutils
+import fusepath
+import local_config
+
+from couchdb import ResourceNotFound
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+WORKERS = 2
+RETRY_DELAY = 30
+
+
+class WritebackQueue:
+    '''
+    Upload written files to the database in background. Every file to upload
+    is recorded in a journal file before being queued, pending uploads are
+    resumed when the queue is restarted.
+    '''
+
+    def __init__(self, db, binary_cache, journal_path, workers=WORKERS):
+        '''
+        Load journal. Workers are started by start (or by the first enqueue)
+        to make sure they run in the process serving the file system.
+        '''
+        self.db = db
+        self.binary_cache = binary_cache
+        self.journal_path = journal_path
+        self.workers = workers
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._uploading = set()
+        self._upload_locks = weakref.WeakValueDictionary()
+        self._started = False
+        self.pending = self._load_journal()
+
+    def start(self):
+        '''
+        Start upload workers and queue uploads left by a previous run.
+        '''
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            binary_ids = list(self.pending.keys())
+
+        for binary_id in binary_ids:
+            self._queue.put(binary_id)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def enqueue(self, file_doc):
+        '''
+        Record that the cached binary of given file must be uploaded, then
+        queue the upload.
+        '''
+        binary_id = file_doc['binary']['file']['id']
+        with self._lock:
+            queued = binary_id in self.pending \
+                and binary_id not in self._uploading
+            self.pending[binary_id] = {
+                'file_id': file_doc['_id'],
+                'binary_id': binary_id,
+            }
+            self._save_journal()
+
+        self.start()
+        if not queued:
+            self._queue.put(binary_id)
+
+    def join(self):
+        '''
+        Wait until every queued upload is done.
+        '''
+        self._queue.join()
+
+    def upload(self, file_id, binary_id):
+        '''
+        Stream cached binary to the attachment of the Binary document, then
+        save new size and binary revision on the File document. The File
+        document is read again after the upload and, on conflict, only these
+        fields are applied to its latest version, so changes made during the
+        upload (like a rename) are kept.
+        '''
+        (filename, size) = self.binary_cache.get_cached_file(binary_id)
+        file_doc = self.db[file_id]
+        binary_doc = self.db[binary_id]
+
+        with open(filename, 'rb') as content:
+            self.db.put_attachment(
+                binary_doc, content, filename='file',
+                content_type=file_doc.get('mime') or
+                'application/octet-stream')
+
+        def update(doc):
+            doc['size'] = size
+            doc['binary']['file']['rev'] = binary_doc['_rev']
+            storage = doc.setdefault('storage', [])
+            if self.binary_cache.name not in storage:
+                storage.append(self.binary_cache.name)
+
+        for doc in dbutils.bulk_update(self.db, [self.db[file_id]], update):
+            dbutils.file_cache.add(
+                fusepath.join(fusepath.normalize_path(doc['path']),
+                              doc['name']), doc)
+        logger.info('[Writeback] %s uploaded (%d bytes)' % (
+            file_doc['name'], size))
+
+    def _work(self):
+        while True:
+            binary_id = self._queue.get()
+            try:
+                # Uploads of the same binary are never run concurrently.
+                # The binary lock is not used, it would block opening the
+                # file during the whole upload.
+                with self._get_upload_lock(binary_id):
+                    with self._lock:
+                        entry = self.pending.get(binary_id)
+                        self._uploading.add(binary_id)
+                    try:
+                        if entry is not None:
+                            self._upload_entry(entry)
+                    finally:
+                        with self._lock:
+                            self._uploading.discard(binary_id)
+            finally:
+                self._queue.task_done()
+
+    def _get_upload_lock(self, binary_id):
+        with self._lock:
+            lock = self._upload_locks.get(binary_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._upload_locks[binary_id] = lock
+            return lock
+
+    def _upload_entry(self, entry):
+        binary_id = entry['binary_id']
+        try:
+            self.upload(entry['file_id'], binary_id)
+        except Exception as e:
+            # Network errors are IOErrors too, only a missing document or
+            # cache file means that the file was removed in the meantime.
+            if not isinstance(e, ResourceNotFound) and \
+               getattr(e, 'errno', None) != errno.ENOENT:
+                logger.exception(
+                    '[Writeback] Upload of %s failed' % binary_id)
+                timer = threading.Timer(
+                    RETRY_DELAY, self._queue.put, (binary_id,))
+                timer.daemon = True
+                timer.start()
+                return
+            logger.info('[Writeback] %s dropped, file is gone' % binary_id)
+
+        with self._lock:
+            # Remove the entry only if no new write was recorded during the
+            # upload, otherwise it is already queued again.
+            if self.pending.get(binary_id) is entry:
+                del self.pending[binary_id]
+                self._save_journal()
+
+    def _load_journal(self):
+        try:
+            with open(self.journal_path, 'r') as journal:
+                return json.load(journal)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_journal(self):
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as journal:
+            json.dump(self.pending, journal)
+        os.rename(tmp_path, self.journal_path)
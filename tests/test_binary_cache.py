@@ -101,3 +101,84 @@ def test_mark_file_as_stored():
     assert file_doc['storage'] == ['cozy-fuse-test']
     binary_cache.mark_file_as_not_stored(file_doc)
     assert file_doc['storage'] == []
+
+def test_partial_cache():
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, DEVICE_CONFIG_PATH, COUCH_URL, MOUNT_FOLDER,
+        block_size=4, readahead=0)
+    path = '/tests/file_test.txt'
+    content = open('./file_test.txt').read()
+    binary_cache.prepare(path)
+    assert not binary_cache.is_cached(path)
+    assert binary_cache.get_current_size(path) == len(content)
+
+    assert not binary_cache.fetch_range(path, 4, 4)
+    with binary_cache.get(path, 'rb') as binary:
+        binary.seek(4)
+        assert binary.read(4) == content[4:8]
+
+    assert binary_cache.fetch_range(path, 0, len(content))
+    assert binary_cache.is_cached(path)
+    with binary_cache.get(path, 'rb') as binary:
+        assert binary.read() == content
+    binary_cache.remove(path)
+
+
+class HeadResponse:
+    status_code = 200
+    headers = {}
+
+
+def test_prepare_without_content_length(config_db):
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, DEVICE_CONFIG_PATH, COUCH_URL, MOUNT_FOLDER)
+    path = '/tests/file_test.txt'
+    content = open('./file_test.txt').read()
+    binary_cache.session.head = lambda url, headers=None: HeadResponse()
+
+    # The file document has no size, the binary is downloaded.
+    (file_doc, binary_id, filename) = binary_cache.get_file_metadata(path)
+    file_doc.pop('size', None)
+    binary_cache.prepare(path)
+    assert binary_cache.is_cached(path)
+    with binary_cache.get(path, 'rb') as binary:
+        assert binary.read() == content
+    binary_cache.remove(path)
+
+    # The size of the file document is used.
+    (file_doc, binary_id, filename) = binary_cache.get_file_metadata(path)
+    file_doc['size'] = len(content)
+    binary_cache.prepare(path)
+    assert not binary_cache.is_cached(path)
+    assert binary_cache.get_current_size(path) == len(content)
+    assert binary_cache.fetch_range(path, 0, len(content))
+    with binary_cache.get(path, 'rb') as binary:
+        assert binary.read() == content
+    binary_cache.remove(path)
+
+
+def test_binary_locks_are_released():
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, DEVICE_CONFIG_PATH, COUCH_URL, MOUNT_FOLDER)
+    lock = binary_cache.get_binary_lock(BINARY_ID)
+    assert binary_cache.get_binary_lock(BINARY_ID) is lock
+    del lock
+    assert len(binary_cache._binary_locks) == 0
+
+
+def test_add_keeps_prepared_file():
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, DEVICE_CONFIG_PATH, COUCH_URL, MOUNT_FOLDER,
+        block_size=4, readahead=0)
+    path = '/tests/file_test.txt'
+    content = open('./file_test.txt').read()
+    binary_cache.prepare(path)
+    assert not binary_cache.is_cached(path)
+
+    # A lazy reader keeps its handle while the binary is fully downloaded.
+    with binary_cache.get(path, 'rb') as binary:
+        binary_cache.add(path)
+        assert binary_cache.is_cached(path)
+        assert binary_cache.fetch_range(path, 0, len(content))
+        assert binary.read() == content
+    binary_cache.remove(path)
@@ -1,7 +1,9 @@
 import pytest
+import os
 import sys
 import datetime
 import time
+import threading
 
 
 sys.path.append('..')
@@ -28,3 +30,77 @@ def test_invalidity():
     assert local_cache.get('test') == 42
     time.sleep(1)
     assert local_cache.get('test') is None
+
+def test_threads():
+    local_cache = cache.Cache()
+
+    def fill(start):
+        for i in range(start, start + 1000):
+            local_cache.add(i, i)
+            assert local_cache.get(i) == i
+            local_cache.remove(i)
+
+    threads = [threading.Thread(target=fill, args=(i * 1000,))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert local_cache._cache == {}
+
+def test_max_size():
+    local_cache = cache.Cache(max_size=2)
+    local_cache.add('a', 1)
+    local_cache.add('b', 2)
+    assert local_cache.get('a') == 1
+    local_cache.add('c', 3)
+    assert local_cache.get('b') is None
+    assert local_cache.get('a') == 1
+    assert local_cache.get('c') == 3
+    assert len(local_cache) == 2
+    local_cache.resize(1)
+    assert local_cache.get('a') is None
+    assert local_cache.get('c') == 3
+
+def test_purge():
+    local_cache = cache.Cache(1)
+    local_cache.add('test', 42)
+    local_cache.purge()
+    assert len(local_cache) == 1
+    time.sleep(1)
+    local_cache.purge()
+    assert len(local_cache) == 0
+
+def test_purger_restarted_after_fork():
+    local_cache = cache.Cache()
+    local_cache.add('a', 1)
+    purger = cache._purger
+    assert purger.is_alive()
+    # Simulate a fork: the purge thread belongs to another process.
+    cache._purger_pid = -1
+    local_cache.add('b', 2)
+    assert cache._purger is not purger
+    assert cache._purger.is_alive()
+    assert cache._purger_pid == os.getpid()
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='clock_gettime is called directly on Linux only')
+def test_linux_clock():
+    clock = cache._get_linux_clock()
+    start = clock()
+    time.sleep(0.01)
+    elapsed = clock() - start
+    assert 0.005 < elapsed < 1
+
+def test_stats():
+    local_cache = cache.Cache(max_size=1)
+    local_cache.add('a', 1)
+    local_cache.get('a')
+    local_cache.get('b')
+    local_cache.add('b', 2)
+    stats = local_cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+    assert stats['size'] == 1
+    assert stats['max_size'] == 1
@@ -0,0 +1,67 @@
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+import cozyfuse.changes as changes
+
+
+class FakeDatabase:
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.calls = []
+
+    def changes(self, **options):
+        self.calls.append(options)
+        feed = self.feeds.pop(0)
+        if isinstance(feed, Exception):
+            raise feed
+        return iter(feed)
+
+
+def test_listen():
+    changes.RETRY_DELAY = 0
+    received = []
+    db = FakeDatabase([
+        [{'seq': 1, 'id': 'a'}, {'seq': 2, 'id': 'b'}],
+        IOError('Connection lost'),
+        [{'seq': 3, 'id': 'c'}],
+    ])
+    listener = changes.ChangesListener(db, since=0, filter='file/all')
+
+    def callback(line):
+        received.append(line['id'])
+        if line['id'] == 'c':
+            listener.stop()
+    listener.subscribe(callback)
+    listener.run()
+
+    assert received == ['a', 'b', 'c']
+    assert listener.seq == 3
+    assert db.calls[0]['feed'] == 'continuous'
+    assert db.calls[0]['filter'] == 'file/all'
+    assert db.calls[1]['since'] == 2
+    assert db.calls[2]['since'] == 2
+
+
+def test_failing_callback():
+    received = []
+    db = FakeDatabase([[{'seq': 1, 'id': 'a'}, {'seq': 2, 'id': 'b'}]])
+    listener = changes.ChangesListener(db, since=0)
+
+    def callback(line):
+        received.append(line['id'])
+        if line['id'] == 'a':
+            raise ValueError('Malformed document')
+        listener.stop()
+    listener.subscribe(callback)
+    listener.run()
+
+    assert received == ['a', 'b']
+    assert listener.seq == 2
+    assert len(db.calls) == 1
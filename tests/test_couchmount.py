@@ -135,7 +135,12 @@ def test_readdir(config_db):
 def test_open(config_db):
     fs = couchmount.CouchFSDocument(TESTDB, local_config.MOUNT_FOLDER,
                          'http://localhost:5984/%s' % TESTDB)
-    assert 0 == fs.open('/file_test.txt', 32769)
+    fh = fs.open('/file_test.txt', 32769)
+    assert isinstance(fh, couchmount.FileHandle)
+    assert fh in fs.file_handles
+    fs.release('/file_test.txt', 32769, fh)
+    assert fh not in fs.file_handles
+    assert fh.fd is None
     assert -errno.ENOENT == fs.open('/file_testa.txt', 32769)
 
 
@@ -154,27 +159,37 @@ def test_write(config_db):
     fs = couchmount.CouchFSDocument(TESTDB, local_config.MOUNT_FOLDER,
                          'http://localhost:5984/%s' % TESTDB)
     path = '/new_file.txt'
-    fs.open(path, os.O_WRONLY | os.O_APPEND)
-    fs.write(path, 'test_write', 0)
+    fh = fs.open(path, os.O_WRONLY | os.O_APPEND)
+    fs.write(path, 'test_write', 0, fh)
     with fs.binary_cache.get(path) as binary:
         content = binary.read()
         assert 'test_write' == content
 
-    fs.write(path, '_again', len('test_write'))
+    fs.write(path, '_again', len('test_write'), fh)
     with fs.binary_cache.get(path) as binary:
         content = binary.read()
         assert 'test_write_again' == content
+    fs.fsdestroy()
+    assert fh.fd is None
 
 
 def test_release(config_db):
     fs = couchmount.CouchFSDocument(TESTDB, local_config.MOUNT_FOLDER,
                          'http://localhost:5984/%s' % TESTDB)
     path = '/new_file.txt'
-    fs.release(path, None)
+    fh = fs.open(path, os.O_WRONLY | os.O_APPEND)
+    fs.write(path, '_release', len('test_write_again'), fh)
+    fs.release(path, os.O_WRONLY | os.O_APPEND, fh)
+    assert fs.getattr(path).st_size == len('test_write_again_release')
+    fs.writeback.join()
 
     db = dbutils.get_db(TESTDB)
-    file_doc = dbutils.get_file(db, path)
-    assert file_doc['size'] == len('test_write_again')
+    file_doc = db[dbutils.get_file(db, path)['_id']]
+    assert file_doc['size'] == len('test_write_again_release')
+    binary_id = file_doc['binary']['file']['id']
+    assert file_doc['binary']['file']['rev'] == db[binary_id]['_rev']
+    attachment = db.get_attachment(binary_id, 'file')
+    assert attachment.read() == 'test_write_again_release'
 
 
 def test_unlink(config_db):
@@ -188,6 +203,8 @@ def test_unlink(config_db):
     assert -errno.ENOENT == fs.open(path, 32769)
     assert -errno.ENOENT == fs.getattr(path)
     assert 'new_file.txt' not in fs._get_names('')
+    assert db.get(binary_id) is None
+    fs.binary_cache.join()
     assert not os.path.exists(filename)
 
 
@@ -241,3 +258,40 @@ def test_rename(config_db):
     assert dbutils.get_file(db, '/C/test.sh') is not None
     assert dbutils.get_folder(db, '/C/B') is not None
 
+
+
+class FailingBulkDatabase:
+    '''
+    Database of which _bulk_docs requests fail for the document "bad".
+    '''
+
+    def update(self, docs):
+        return [(doc['_id'] != 'bad', doc['_id'], ValueError('Bad doc'))
+                for doc in docs]
+
+
+class FolderUpdates:
+
+    def __init__(self):
+        self.paths = []
+
+    def add(self, path, date):
+        self.paths.append(path)
+
+
+def test_commit_deletions_partial_failure():
+    fs = couchmount.CouchFSDocument.__new__(couchmount.CouchFSDocument)
+    fs.db = FailingBulkDatabase()
+    fs.folder_updates = FolderUpdates()
+    docs = [
+        {'_id': 'good', '_rev': '1', 'docType': 'File', 'path': '/A',
+         'name': 'good.txt', 'binary': {'file': {'id': 'b1', 'rev': '1'}}},
+        {'_id': 'bad', '_rev': '1', 'docType': 'Folder', 'path': '/B',
+         'name': 'bad'},
+    ]
+
+    results = fs._commit_deletions(docs)
+
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert fs.folder_updates.paths == ['/A']
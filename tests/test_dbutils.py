@@ -104,12 +104,176 @@ def get_device():
     db.create(device)
 
 
+def test_update_file_conflict(config_db):
+    db = dbutils.get_db(TESTDB)
+    file_doc = dbutils.create_file(db, {
+        'docType': 'File',
+        'path': '',
+        'name': 'conflict.txt',
+        'size': 0,
+    })
+    concurrent_doc = db[file_doc['_id']]
+    concurrent_doc['size'] = 10
+    db.save(concurrent_doc)
+
+    file_doc['size'] = 20
+    dbutils.update_file(db, file_doc)
+    assert file_doc['_rev'] == db[file_doc['_id']]['_rev']
+    assert db[file_doc['_id']]['size'] == 20
+
+    dbutils.delete_file(db, file_doc)
+    assert db.get(file_doc['_id']) is None
+
+
+def test_get_progress(config_db):
+    db = dbutils.get_db(TESTDB)
+    before = dbutils.get_progress(db, TESTDB)
+
+    binary = {'docType': 'Binary'}
+    db.save(binary)
+    db.put_attachment(binary, 'content', filename='file')
+    stored_doc = dbutils.create_file(db, {
+        'docType': 'File',
+        'path': '',
+        'name': 'stored.txt',
+        'size': 7,
+        'storage': [TESTDB, 'other-device'],
+        'binary': {'file': {'id': binary['_id']}},
+    })
+    remote_doc = dbutils.create_file(db, {
+        'docType': 'File',
+        'path': '',
+        'name': 'remote.txt',
+        'size': 10,
+        'storage': ['other-device'],
+    })
+
+    progress = dbutils.get_progress(db, TESTDB)
+    assert progress['files'] == before['files'] + 2
+    assert progress['binaries'] == before['binaries'] + 1
+    assert progress['bytes'] == before['bytes'] + 17
+    assert progress['bytes_cached'] == before['bytes_cached'] + 7
+    other = dbutils.get_progress(db, 'other-device')
+    assert other['bytes_cached'] == 17
+
+    dbutils.delete_file(db, stored_doc)
+    dbutils.delete_file(db, remote_doc)
+    db.delete(db[binary['_id']])
+    assert dbutils.get_progress(db, TESTDB) == before
+
+
+class FailingBulkDatabase:
+    '''
+    Database of which _bulk_docs requests fail for documents named "bad".
+    '''
+
+    def update(self, docs):
+        return [(doc['name'] != 'bad', doc['_id'], ValueError('Bad doc'))
+                for doc in docs]
+
+
+def test_bulk_update_errors(monkeypatch):
+    monkeypatch.setattr(dbutils, 'BULK_SIZE', 2)
+    docs = [{'_id': str(i), 'name': name}
+            for (i, name) in enumerate(['a', 'bad', 'b', 'c'])]
+
+    def update(doc):
+        doc['updated'] = True
+
+    with pytest.raises(dbutils.BulkUpdateError) as error:
+        dbutils.bulk_update(FailingBulkDatabase(), docs, update)
+    assert [doc_id for (doc_id, e) in error.value.errors] == ['1']
+    assert [doc['_id'] for doc in error.value.saved_docs] == ['0', '2', '3']
+    assert all(doc['updated'] for doc in docs)
+
+
+class RecordingDatabase:
+    '''
+    Database recording _bulk_docs requests, File documents named "bad" are
+    rejected.
+    '''
+
+    def __init__(self):
+        self.requests = []
+
+    def update(self, docs):
+        self.requests.append(docs)
+        return [(doc.get('name') != 'bad', doc['_id'],
+                 '1-rev' if doc.get('name') != 'bad' else ValueError('Bad'))
+                for doc in docs]
+
+
+def test_create_files_deletes_orphan_binaries():
+    db = RecordingDatabase()
+    file_docs = [{'docType': 'File', 'path': '/create', 'name': name}
+                 for name in ['good', 'bad']]
+
+    results = dbutils.create_files(db, file_docs)
+
+    assert results[0] is file_docs[0]
+    assert isinstance(results[1], ValueError)
+    assert len(db.requests) == 3
+    binary_ids = [doc['_id'] for doc in db.requests[0]]
+    assert db.requests[2] == [
+        {'_id': binary_ids[1], '_rev': '1-rev', '_deleted': True}]
+    assert 'binary' not in file_docs[1]
+    dbutils.file_cache.remove('/create/good')
+
+
 def init_db():
     pass
     # Not tested yet, because  I'm not sure it won't changed.
 
 
 
+class Row:
+
+    def __init__(self, value):
+        self.value = value
+
+
+class LegacyDatabase:
+    '''
+    Database initialized before the tree view existed. The tree design
+    document can be created only if *writable* is True.
+    '''
+
+    def __init__(self, name, writable):
+        self.name = name
+        self.writable = writable
+        self.docs = {}
+        self.queries = []
+
+    def __setitem__(self, doc_id, doc):
+        if not self.writable:
+            raise dbutils.http.Unauthorized('Not an admin')
+        self.docs[doc_id] = doc
+
+    def view(self, name, **options):
+        self.queries.append(name)
+        if name.startswith('tree/') and '_design/tree' not in self.docs:
+            raise dbutils.ResourceNotFound('missing')
+        return [Row({'name': 'a', 'docType': 'File', 'size': 1,
+                     'lastModification': 'date', 'path': '/'})]
+
+
+def test_tree_view_created_on_first_use():
+    db = LegacyDatabase('legacy-writable', writable=True)
+    assert len(dbutils.get_folder_content(db, '/')) == 1
+    assert '_design/tree' in db.docs
+    assert db.queries == ['tree/byParent', 'tree/byParent']
+    dbutils.get_subtree(db, '/')
+    assert db.queries[2:] == ['tree/bySubtree']
+
+
+def test_missing_tree_view_not_queried_again():
+    db = LegacyDatabase('legacy-readonly', writable=False)
+    assert len(dbutils.get_folder_content(db, '/')) == 2
+    del db.queries[:]
+    assert len(dbutils.get_folder_content(db, '/')) == 2
+    assert db.queries == ['file/byFolder', 'folder/byFolder']
+
+
 def test_remove_db():
     dbutils.remove_db(TESTDB)
     db = dbutils.get_db(TESTDB)
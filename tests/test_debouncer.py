@@ -0,0 +1,32 @@
+import sys
+import time
+
+sys.path.append('..')
+
+import cozyfuse.debouncer as debouncer
+
+
+def test_coalesce():
+    flushes = []
+    updates = debouncer.Debouncer(flushes.append, window=0.1)
+    updates.add('/A', 1)
+    updates.add('/A', 2)
+    updates.add('/B', 3)
+    assert flushes == []
+    assert len(updates) == 2
+    time.sleep(0.3)
+    assert flushes == [{'/A': 2, '/B': 3}]
+    assert len(updates) == 0
+
+
+def test_flush():
+    flushes = []
+    updates = debouncer.Debouncer(flushes.append, window=60)
+    updates.add('/A', 1)
+    updates.flush()
+    updates.flush()
+    assert flushes == [{'/A': 1}]
+
+    updates = debouncer.Debouncer(flushes.append, window=0)
+    updates.add('/B', 2)
+    assert flushes == [{'/A': 1}, {'/B': 2}]
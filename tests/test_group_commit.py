@@ -0,0 +1,46 @@
+import sys
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.groupcommit as groupcommit
+
+
+def test_batches():
+    batches = []
+
+    def commit(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    group = groupcommit.GroupCommit(commit, window=0.05)
+    results = {}
+
+    def submit(item):
+        results[item] = group.submit(item)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == dict((i, i * 2) for i in range(20))
+    assert sum(len(batch) for batch in batches) == 20
+    assert len(batches) < 20
+
+
+def test_errors():
+
+    def commit(items):
+        return [ValueError(item) if item == 'bad' else item
+                for item in items]
+
+    group = groupcommit.GroupCommit(commit, window=0)
+    assert group.submit('good') == 'good'
+    try:
+        group.submit('bad')
+        assert False
+    except ValueError:
+        pass
+    assert group.submit('good') == 'good'
@@ -1,6 +1,7 @@
 import sys
 import os
 import pytest
+import logging
 
 sys.path.append('..')
 
@@ -68,6 +69,17 @@ def test_no_config(config_file):
                   'test-no-device')
 
 
+def test_get_log_level():
+    levels = 'warning,couchmount=debug,binarycache=unknown'
+    assert logging.WARNING == \
+        local_config.get_log_level('cozyfuse.dbutils', levels)
+    assert logging.DEBUG == \
+        local_config.get_log_level('cozyfuse.couchmount', levels)
+    assert logging.WARNING == \
+        local_config.get_log_level('cozyfuse.binarycache', levels)
+    assert logging.INFO == local_config.get_log_level('cozyfuse.dbutils', '')
+
+
 def test_clear_config(config_file):
     local_config.clear()
     assert False == os.path.isfile(local_config.CONFIG_PATH)
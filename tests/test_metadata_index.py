@@ -0,0 +1,96 @@
+import pytest
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+import cozyfuse.metadataindex as metadataindex
+
+INDEX_PATH = os.path.join(local_config.CONFIG_FOLDER, 'metadata-test.db')
+
+
+class FakeDatabase:
+
+    def __init__(self, results):
+        self.results = results
+
+    def changes(self, since=0, limit=None, **kwargs):
+        results = [line for line in self.results if line['seq'] > since]
+        results = results[:limit]
+        if len(results) > 0:
+            last_seq = results[-1]['seq']
+        else:
+            last_seq = since
+        return {'results': results, 'last_seq': last_seq}
+
+
+def change(seq, doc_id, doc=None):
+    line = {'seq': seq, 'id': doc_id, 'doc': doc}
+    if doc is None:
+        line['deleted'] = True
+    return line
+
+
+@pytest.fixture
+def index(request):
+    if not os.path.isdir(local_config.CONFIG_FOLDER):
+        os.mkdir(local_config.CONFIG_FOLDER)
+    index = metadataindex.MetadataIndex(INDEX_PATH)
+
+    def fin():
+        index.close()
+        os.remove(INDEX_PATH)
+    request.addfinalizer(fin)
+    return index
+
+
+def test_sync(index):
+    db = FakeDatabase([
+        change(1, 'a', {'_id': 'a', 'docType': 'Folder',
+                        'path': '', 'name': 'A'}),
+        change(2, 'b', {'_id': 'b', 'docType': 'File',
+                        'path': '/A', 'name': 'b.txt', 'size': 10}),
+        change(3, 'c', {'_id': 'c', 'docType': 'Device', 'login': 'test'}),
+    ])
+    assert not index.is_ready()
+    index.sync(db)
+    assert index.is_ready()
+    assert index.get('/A')['docType'] == 'Folder'
+    assert index.get('/A/b.txt')['size'] == 10
+    assert index.get('/C') is None
+    assert [entry['name'] for entry in index.list('/A')] == ['b.txt']
+    assert index.get_path('b') == '/A/b.txt'
+
+
+def test_changes(index):
+    db = FakeDatabase([
+        change(1, 'a', {'_id': 'a', 'docType': 'Folder',
+                        'path': '', 'name': 'A'}),
+        change(2, 'b', {'_id': 'b', 'docType': 'File',
+                        'path': '/A', 'name': 'b.txt', 'size': 10}),
+    ])
+    index.sync(db)
+    db.results.append(change(3, 'b', {'_id': 'b', 'docType': 'File',
+                                      'path': '', 'name': 'c.txt'}))
+    db.results.append(change(4, 'a'))
+    index.sync(db)
+    assert index.get('/A') is None
+    assert index.get('/A/b.txt') is None
+    assert index.get('/c.txt')['docType'] == 'File'
+
+
+def test_warm_restart(index):
+    db = FakeDatabase([
+        change(1, 'a', {'_id': 'a', 'docType': 'Folder',
+                        'path': '', 'name': 'A'}),
+    ])
+    index.sync(db)
+    restarted_index = metadataindex.MetadataIndex(INDEX_PATH)
+    assert restarted_index.is_ready()
+    assert restarted_index.seq == 1
+    assert restarted_index.get('/A') is not None
+    restarted_index.close()
@@ -0,0 +1,37 @@
+import sys
+
+sys.path.append('..')
+
+import cozyfuse.cache as cache
+import cozyfuse.metrics as metrics
+
+
+def test_timed():
+    metrics.reset()
+
+    @metrics.timed('test_operation')
+    def getattr(path):
+        if path == '/missing':
+            return -2
+        return 0
+
+    getattr('/file')
+    getattr('/missing')
+    text = metrics.render()
+    assert 'test_operation_seconds_count{op="getattr"} 2' in text
+    assert 'test_operation_seconds_bucket{op="getattr",le="+Inf"} 2' in text
+    assert 'test_operation_errors_total{op="getattr"} 1' in text
+
+
+def test_cache_hit_ratio():
+    metrics.reset()
+    attr_cache = cache.Cache()
+    metrics.register_cache('attr', attr_cache)
+    attr_cache.add('/file', 1)
+    attr_cache.get('/file')
+    attr_cache.get('/file')
+    attr_cache.get('/missing')
+    attr_cache.get('/missing')
+    text = metrics.render()
+    assert 'cozyfuse_cache_hits_total{cache="attr"} 2' in text
+    assert 'cozyfuse_cache_hit_ratio{cache="attr"} 0.5' in text
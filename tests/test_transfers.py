@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.transfers as transfers
+
+
+def start(function, *args):
+    thread = threading.Thread(target=function, args=args)
+    thread.start()
+    return thread
+
+
+def test_priorities():
+    scheduler = transfers.TransferScheduler(max_transfers=1)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def block(transfer):
+        started.set()
+        release.wait()
+
+    def record(name):
+        return lambda transfer: order.append(name)
+
+    threads = [start(scheduler.run, 'blocking', block)]
+    started.wait()
+    for (key, priority) in [('background', transfers.BACKGROUND),
+                            ('prefetch', transfers.PREFETCH),
+                            ('interactive', transfers.INTERACTIVE)]:
+        threads.append(start(scheduler.run, key, record(key), priority))
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert order == ['interactive', 'prefetch', 'background']
+
+
+def test_merge():
+    scheduler = transfers.TransferScheduler(max_transfers=1)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def download(transfer):
+        calls.append(transfer.key)
+        started.set()
+        release.wait()
+        return 42
+
+    def run():
+        results.append(scheduler.run('binary', download))
+
+    threads = [start(run)]
+    started.wait()
+    threads += [start(run) for i in range(3)]
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ['binary']
+    assert results == [42] * 4
+
+
+def test_errors():
+    scheduler = transfers.TransferScheduler()
+
+    def fail(transfer):
+        raise ValueError('failed')
+
+    try:
+        scheduler.run('binary', fail)
+        assert False
+    except ValueError:
+        pass
+    assert scheduler.run('binary', lambda transfer: 'ok') == 'ok'
+
+
+def test_preemption():
+    scheduler = transfers.TransferScheduler(max_transfers=1)
+    started = threading.Event()
+    order = []
+
+    def background(transfer):
+        started.set()
+        for chunk in range(20):
+            order.append('background')
+            time.sleep(0.01)
+            transfer.checkpoint()
+
+    thread = start(scheduler.run, 'big', background, transfers.BACKGROUND)
+    started.wait()
+    scheduler.run('small', lambda transfer: order.append('interactive'))
+    thread.join()
+
+    assert order.index('interactive') < len(order) - 1
+    assert order.count('background') == 20
+
+
+def test_activity():
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        transfers.mark_activity(filename)
+        start_time = time.time()
+        transfers.wait_for_inactivity(filename, delay=0.2)
+        assert time.time() - start_time >= 0.15
+        transfers.wait_for_inactivity(filename + '.missing', delay=10)
+    finally:
+        os.remove(filename)
+
+
+def test_prefetch_waits_for_other_processes():
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        scheduler = transfers.TransferScheduler(activity_file=filename)
+        transfers.mark_activity(filename)
+        start_time = time.time()
+        scheduler.run('binary', lambda transfer: None, transfers.PREFETCH)
+        assert time.time() - start_time >= transfers.ACTIVITY_DELAY - 0.1
+    finally:
+        os.remove(filename)
+
+
+def test_activity_marked_once_per_interval(monkeypatch):
+    marks = []
+    monkeypatch.setattr(transfers, 'mark_activity', marks.append)
+    scheduler = transfers.TransferScheduler(activity_file='activity')
+
+    def download(transfer):
+        for chunk in range(10):
+            transfer.checkpoint()
+
+    scheduler.run('binary', download)
+    assert marks == ['activity']
+
+
+def test_upgraded_transfer_stops_waiting():
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        scheduler = transfers.TransferScheduler(activity_file=filename)
+        transfers.mark_activity(filename)
+        start_time = time.time()
+        thread = start(scheduler.run, 'binary', lambda transfer: None,
+                       transfers.BACKGROUND)
+        time.sleep(0.1)
+        scheduler.run('binary', lambda transfer: None)
+        thread.join()
+        assert time.time() - start_time < transfers.ACTIVITY_DELAY - 0.5
+    finally:
+        os.remove(filename)
@@ -0,0 +1,122 @@
+import os
+import sys
+import errno
+import socket
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.writeback as writeback
+
+from couchdb.http import ResourceConflict
+
+
+class FakeBinaryCache:
+    name = 'test-device'
+
+    def __init__(self, filename=None):
+        self.filename = filename
+
+    def get_binary_lock(self, binary_id):
+        return threading.Lock()
+
+    def get_cached_file(self, binary_id):
+        return (self.filename, os.path.getsize(self.filename))
+
+
+class RenamingDb:
+    '''
+    Fake database where the file is renamed while its content is uploaded.
+    '''
+
+    def __init__(self):
+        self.docs = {
+            'file-id': {'_id': 'file-id', '_rev': '1', 'name': 'old.txt',
+                        'path': '/folder', 'size': 0,
+                        'binary': {'file': {'id': 'binary-id', 'rev': '1'}}},
+            'binary-id': {'_id': 'binary-id', '_rev': '1'},
+        }
+
+    def __getitem__(self, doc_id):
+        return dict(self.docs[doc_id])
+
+    def get(self, doc_id):
+        return self[doc_id]
+
+    def put_attachment(self, doc, content, filename, content_type):
+        content.read()
+        doc['_rev'] = self.docs['binary-id']['_rev'] = '2'
+        renamed = self['file-id']
+        renamed.update({'_rev': '2', 'name': 'new.txt'})
+        self.docs['file-id'] = renamed
+
+    def update(self, docs):
+        results = []
+        for doc in docs:
+            if doc['_rev'] != self.docs[doc['_id']]['_rev']:
+                results.append((False, doc['_id'], ResourceConflict()))
+            else:
+                doc['_rev'] = str(int(doc['_rev']) + 1)
+                self.docs[doc['_id']] = dict(doc)
+                results.append((True, doc['_id'], doc['_rev']))
+        return results
+
+
+class FailingWritebackQueue(writeback.WritebackQueue):
+
+    def __init__(self, journal_path, error):
+        writeback.WritebackQueue.__init__(
+            self, None, FakeBinaryCache(), journal_path)
+        self.error = error
+
+    def upload(self, file_id, binary_id):
+        raise self.error
+
+
+def get_entry():
+    return {'file_id': 'file-id', 'binary_id': 'binary-id'}
+
+
+def test_network_error_keeps_entry(tmpdir, monkeypatch):
+    journal_path = str(tmpdir.join('journal.json'))
+    queue = FailingWritebackQueue(
+        journal_path, socket.error(errno.ECONNREFUSED, 'refused'))
+    monkeypatch.setattr(writeback, 'RETRY_DELAY', 3600)
+    entry = get_entry()
+    queue.pending['binary-id'] = entry
+    queue._save_journal()
+
+    queue._upload_entry(entry)
+
+    assert 'binary-id' in queue.pending
+    assert 'binary-id' in writeback.WritebackQueue(
+        None, FakeBinaryCache(), journal_path).pending
+
+
+def test_missing_cache_file_drops_entry(tmpdir):
+    journal_path = str(tmpdir.join('journal.json'))
+    queue = FailingWritebackQueue(
+        journal_path, OSError(errno.ENOENT, 'No such file'))
+    entry = get_entry()
+    queue.pending['binary-id'] = entry
+    queue._save_journal()
+
+    queue._upload_entry(entry)
+
+    assert 'binary-id' not in queue.pending
+
+
+def test_upload_keeps_concurrent_rename(tmpdir):
+    content = tmpdir.join('content')
+    content.write('data')
+    db = RenamingDb()
+    queue = writeback.WritebackQueue(
+        db, FakeBinaryCache(str(content)), str(tmpdir.join('journal.json')))
+
+    queue.upload('file-id', 'binary-id')
+
+    file_doc = db.docs['file-id']
+    assert file_doc['name'] == 'new.txt'
+    assert file_doc['size'] == 4
+    assert file_doc['binary']['file']['rev'] == '2'
+    assert file_doc['storage'] == ['test-device']